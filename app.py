@@ -8,16 +8,26 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import JWTManager
 from itsdangerous import URLSafeTimedSerializer
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from dotenv import load_dotenv
+from hashing import HashingService
+from storage import HashingRequest, create_storage
+from thumbnails import ThumbnailService
 
 # Load variables from .env file
 load_dotenv()
 
 app = Flask(__name__)
+# uploaded files are hashed while they are received (content-addressed image storage)
+app.request_class = HashingRequest
 
 # db config
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///./users.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///./users.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# the rate limiter writes on every throttled request, its buckets live in a database file of their own
+app.config['SQLALCHEMY_BINDS'] = {
+    'ratelimit': {'url': os.environ.get('RATELIMIT_DATABASE_URL', 'sqlite:///./ratelimit.db'), 'connect_args': {'timeout': 1}},
+}
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
 # jwt config
 app.config['JWT_SECRET_KEY'] = os.environ['JWT_SECRET_KEY']
@@ -26,17 +36,88 @@ app.config['JWT_REFRESH_TOKEN_EXPIRES'] = datetime.timedelta(minutes=43200)  # 3
 # mail config
 app.config['MAIL_SERVER'] = os.environ['MAIL_SERVER']
 app.config['MAIL_PORT'] = os.environ['MAIL_PORT']
-app.config['MAIL_USE_SSL'] = True
-app.config['MAIL_USERNAME'] = os.environ['MAIL_USERNAME']
-app.config['MAIL_PASSWORD'] = os.environ['MAIL_PASSWORD']
+app.config['MAIL_USE_SSL'] = os.environ.get('MAIL_USE_SSL', 'true').lower() == 'true'
+# false for a local SMTP server without AUTH (e.g. aiosmtpd), MAIL_USERNAME is still the sender address
+app.config['MAIL_USE_AUTH'] = os.environ.get('MAIL_USE_AUTH', 'true').lower() == 'true'
+app.config['MAIL_USERNAME'] = os.environ['MAIL_USERNAME'] if app.config['MAIL_USE_AUTH'] else None
+app.config['MAIL_PASSWORD'] = os.environ['MAIL_PASSWORD'] if app.config['MAIL_USE_AUTH'] else None
 app.config['MAIL_DEFAULT_SENDER'] = ('Bounden', os.environ['MAIL_USERNAME'])
+# mail outbox config (emails are queued in the database and sent by a background thread of each worker)
+app.config['MAIL_OUTBOX_WORKER'] = os.environ.get('MAIL_OUTBOX_WORKER', 'true').lower() == 'true'  # false: only 'flask send-mail' sends
+app.config['MAIL_OUTBOX_BATCH_SIZE'] = int(os.environ.get('MAIL_OUTBOX_BATCH_SIZE', 20))  # messages per SMTP connection
+app.config['MAIL_OUTBOX_POLL_INTERVAL'] = int(os.environ.get('MAIL_OUTBOX_POLL_INTERVAL', 10))  # seconds
+app.config['MAIL_OUTBOX_CLAIM_TIMEOUT'] = int(os.environ.get('MAIL_OUTBOX_CLAIM_TIMEOUT', 300))  # seconds
+app.config['MAIL_OUTBOX_RETRY_DELAY'] = int(os.environ.get('MAIL_OUTBOX_RETRY_DELAY', 30))  # seconds, doubled on every attempt
+app.config['MAIL_OUTBOX_MAX_ATTEMPTS'] = int(os.environ.get('MAIL_OUTBOX_MAX_ATTEMPTS', 6))
+app.config['MAIL_DEDUP_WINDOW'] = int(os.environ.get('MAIL_DEDUP_WINDOW', 60))  # seconds
+# password hashing config (pbkdf2 runs in a process pool, requests get a 503 when the pool and its queue are full)
+app.config['PASSWORD_HASH_ROUNDS'] = int(os.environ.get('PASSWORD_HASH_ROUNDS', 29000))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_QUEUE_SIZE'] = int(os.environ.get('PASSWORD_HASH_QUEUE_SIZE', 8))
+# authenticated user cache config (per worker, saving a user invalidates it in the same worker only)
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))  # seconds
+# image storage config ('cos' bucket, or 'local' files served by the app for development / load tests)
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'cos')
+app.config['COS_SECRET_ID'] = os.environ.get('COS_SECRET_ID')
+app.config['COS_SECRET_KEY'] = os.environ.get('COS_SECRET_KEY')
+app.config['COS_REGION'] = os.environ.get('COS_REGION', 'ap-nanjing')
+app.config['COS_BUCKET'] = os.environ.get('COS_BUCKET', 'bounden-1312559530')
+app.config['LOCAL_STORAGE_ROOT'] = os.environ.get('LOCAL_STORAGE_ROOT', os.path.join(app.instance_path, 'storage'))
+app.config['STORAGE_CACHE_MAX_AGE'] = int(os.environ.get('STORAGE_CACHE_MAX_AGE', 3600))  # seconds, local files that are not content-addressed
+app.config['STORAGE_MULTIPART_THRESHOLD'] = int(os.environ.get('STORAGE_MULTIPART_THRESHOLD', 4 * 1024 * 1024))  # bytes
+app.config['STORAGE_PART_SIZE'] = int(os.environ.get('STORAGE_PART_SIZE', 1))  # MB
+app.config['STORAGE_UPLOAD_THREADS'] = int(os.environ.get('STORAGE_UPLOAD_THREADS', 4))
+# uploads are rejected upfront (413) when the request is larger, the form parser spools the files to disk
+app.config['IMAGE_MAX_SIZE'] = int(os.environ.get('IMAGE_MAX_SIZE', 20 * 1024 * 1024))  # bytes
+app.config['MAX_CONTENT_LENGTH'] = app.config['IMAGE_MAX_SIZE'] + 64 * 1024
+# batch uploads: up to IMAGE_BATCH_MAX_FILES files per request, stored concurrently by IMAGE_BATCH_THREADS threads
+app.config['IMAGE_BATCH_MAX_FILES'] = int(os.environ.get('IMAGE_BATCH_MAX_FILES', 10))
+app.config['IMAGE_BATCH_MAX_SIZE'] = int(os.environ.get('IMAGE_BATCH_MAX_SIZE', 100 * 1024 * 1024))  # bytes, the whole request
+app.config['IMAGE_BATCH_THREADS'] = int(os.environ.get('IMAGE_BATCH_THREADS', 4))
+app.config['IMAGE_PRESIGN_EXPIRES'] = int(os.environ.get('IMAGE_PRESIGN_EXPIRES', 600))  # seconds
+# resized WebP / JPEG variants of the uploaded images, rendered in a process pool
+app.config['THUMBNAIL_WIDTHS'] = tuple(int(width) for width in os.environ.get('THUMBNAIL_WIDTHS', '320,768,1600').split(','))
+app.config['THUMBNAIL_WORKERS'] = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+app.config['THUMBNAIL_TIMEOUT'] = int(os.environ.get('THUMBNAIL_TIMEOUT', 30))  # seconds
+# rate limit config of signin / signup / forgot password (token buckets: LIMIT requests per PERIOD seconds, bursts up to LIMIT)
+app.config['RATELIMIT_ENABLED'] = os.environ.get('RATELIMIT_ENABLED', 'true').lower() == 'true'
+app.config['RATELIMIT_IP_LIMIT'] = int(os.environ.get('RATELIMIT_IP_LIMIT', 20))
+app.config['RATELIMIT_IP_PERIOD'] = int(os.environ.get('RATELIMIT_IP_PERIOD', 60))  # seconds
+app.config['RATELIMIT_EMAIL_LIMIT'] = int(os.environ.get('RATELIMIT_EMAIL_LIMIT', 5))
+app.config['RATELIMIT_EMAIL_PERIOD'] = int(os.environ.get('RATELIMIT_EMAIL_PERIOD', 300))  # seconds
+# number of reverse proxies (e.g. nginx, the Render load balancer) in front of the app, their X-Forwarded-For gives the client ip
+# (0 if the app is reachable without a proxy, otherwise clients could choose the ip of their rate limit bucket)
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 1))
+# pagination config (largest page a client can ask for)
+app.config['BLOGS_MAX_PER_PAGE'] = int(os.environ.get('BLOGS_MAX_PER_PAGE', 50))
+app.config['COMMENTS_MAX_PER_PAGE'] = int(os.environ.get('COMMENTS_MAX_PER_PAGE', 100))
+app.config['USERS_MAX_PER_PAGE'] = int(os.environ.get('USERS_MAX_PER_PAGE', 100))
+app.config['IMAGES_MAX_PER_PAGE'] = int(os.environ.get('IMAGES_MAX_PER_PAGE', 100))
+# cached total of the blog feeds (include_total), per worker and per author
+app.config['BLOGS_TOTAL_CACHE_SIZE'] = int(os.environ.get('BLOGS_TOTAL_CACHE_SIZE', 1024))
+app.config['BLOGS_TOTAL_CACHE_TTL'] = int(os.environ.get('BLOGS_TOTAL_CACHE_TTL', 60))  # seconds
+# feed cache config (per worker, invalidated across workers by the 'blogs' cache generation)
+app.config['FEED_CACHE_SIZE'] = int(os.environ.get('FEED_CACHE_SIZE', 256))
+app.config['FEED_CACHE_TTL'] = int(os.environ.get('FEED_CACHE_TTL', 30))  # seconds
+
+if 'TRUSTED_PROXIES' not in os.environ:
+    app.logger.warning('TRUSTED_PROXIES is not set, assuming 1 reverse proxy: the client ip is read from X-Forwarded-For')
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'], x_proto=app.config['TRUSTED_PROXIES'])
 
 # Initialize extensions
 serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
 api = Api(app)
 mail = Mail(app)
+hasher = HashingService(app)
+storage = create_storage(app)
+thumbnailer = ThumbnailService(app)
 db = SQLAlchemy(app)
-migrate = Migrate(app, db, render_as_batch=True)
+# the FTS5 tables of the search index are managed by search.py, keep them out of the autogenerated migrations
+def include_name(name, type_, parent_names):
+    return not (type_ == 'table' and name.startswith('blogs_fts'))
+migrate = Migrate(app, db, render_as_batch=True, include_name=include_name)
 CORS(app, resources={r"/*": {"origins": ["*", "http://localhost:3000", "https://*.bounden.cn"]}})
 
 @app.before_request
@@ -46,12 +127,15 @@ def create_tables():
     app.before_request_funcs[None].remove(create_tables)
 
     db.create_all()
+    search.create_index()
+    # send what is left in the outbox (e.g. after a restart)
+    outbox.sender.wake()
 
 # Initialize the JWT manager
 jwt = JWTManager(app)
 
 
-import views, resources_user, resources_blog, resources_image, resources_memoryMapMarker
+import views, search, outbox, commands, resources_user, resources_blog, resources_image, resources_memoryMapMarker
 
 api.add_resource(resources_user.UserVerifyEmail, '/verify_email/<string:token>')
 api.add_resource(resources_user.UserForgotPassword, '/forgot_password')
@@ -61,18 +145,30 @@ api.add_resource(resources_user.UserSignUp, '/signup')
 api.add_resource(resources_user.UserSignIn, '/signin')
 api.add_resource(resources_user.TokenRefresh, '/token/refresh')
 api.add_resource(resources_user.AllUsers, '/users')
+api.add_resource(resources_user.RateLimitStats, '/ratelimit/stats')
 api.add_resource(resources_user.UserAllBlogs, '/users/<email>/blogs')
 
 api.add_resource(resources_blog.BlogCreate, '/blogs/create')
 api.add_resource(resources_blog.BlogUpdate, '/blogs/edit/<int:id>')
 api.add_resource(resources_blog.AllBlogs, '/blogs')
+api.add_resource(resources_blog.BlogSearch, '/blogs/search')
+api.add_resource(resources_blog.BlogExport, '/blogs/export')
 api.add_resource(resources_blog.BlogWithId, '/blogs/<int:id>')
+api.add_resource(resources_blog.BlogContent, '/blogs/<int:id>/content')
 api.add_resource(resources_blog.CommentPost, '/blogs/<int:id>/comments/create')
+api.add_resource(resources_blog.CommentImport, '/blogs/<int:id>/comments/import')
 api.add_resource(resources_blog.CommentWithId, '/blogs/<int:id>/comments/<int:commentId>')
 api.add_resource(resources_blog.AllComments, '/blogs/<int:id>/comments')
+api.add_resource(resources_blog.CommentTree, '/blogs/<int:id>/comments/tree')
 api.add_resource(resources_blog.CommentReplies, '/blogs/<int:id>/comments/<int:commentId>/replies')
 
 api.add_resource(resources_image.ImageUpload, '/images/upload')
+api.add_resource(resources_image.ImageBatchUpload, '/images/upload/batch')
+api.add_resource(resources_image.ImageWithId, '/images/<int:id>')
+api.add_resource(resources_image.ImagePresign, '/images/presign')
+api.add_resource(resources_image.ImageConfirm, '/images/confirm')
+api.add_resource(resources_image.AllImages, '/images')
+api.add_resource(resources_image.UserImages, '/users/<email>/images')
 
 api.add_resource(resources_memoryMapMarker.MemoryMapMarkerCreate, '/memory_map_markers/create')
 api.add_resource(resources_memoryMapMarker.MemoryMapMarkerUpdate, '/memory_map_markers/edit')
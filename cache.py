@@ -0,0 +1,44 @@
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    """
+    A small thread-safe LRU cache whose entries also expire after ttl seconds.
+    (the cache lives inside one worker process, put a shared generation in the key to invalidate it across workers)
+    """
+
+    def __init__(self, maxsize=128, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            # mark as the most recently used
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            # evict the least recently used entries
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,108 @@
+import click
+import outbox
+import search
+from app import app, db
+from models import Blog, Comment, MemoryMapMarker
+from sqlalchemy import func, text, update
+from sqlalchemy.schema import CreateTable
+
+# maintenance commands, run with 'flask <command>' (e.g. FLASK_APP=app.py flask rebuild-search-index)
+
+def rebuild_table(model, conversions):
+    """
+    Rebuild a table with the current schema of its model, SQLite cannot change the type of a column in place.
+    (create the new table, copy the rows, drop the old table, rename the new one and recreate the indexes)
+
+    :param model: The model whose table is rebuilt.
+    :param conversions: SQL expressions that convert the old values, keyed by column name.
+    :return: The number of copied rows.
+    """
+    table = model.__table__
+    new_name = table.name + '__new'
+    with db.engine.begin() as conn:
+        existing_columns = [row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{table.name}")')]
+        columns = [column.name for column in table.columns if column.name in existing_columns]
+        create_sql = str(CreateTable(table).compile(dialect=db.engine.dialect)).replace(f'CREATE TABLE {table.name} ', f'CREATE TABLE {new_name} ', 1)
+
+        conn.exec_driver_sql(f'DROP TABLE IF EXISTS {new_name}')
+        conn.exec_driver_sql(create_sql)
+        select_list = ', '.join(conversions.get(column, f'"{column}"') for column in columns)
+        column_list = ', '.join(f'"{column}"' for column in columns)
+        count = conn.exec_driver_sql(f'INSERT INTO {new_name} ({column_list}) SELECT {select_list} FROM "{table.name}"').rowcount
+        conn.exec_driver_sql(f'DROP TABLE "{table.name}"')
+        conn.exec_driver_sql(f'ALTER TABLE {new_name} RENAME TO "{table.name}"')
+        for index in table.indexes:
+            index.create(conn)
+    return count
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Rebuild the full-text search index of the blogs from the blogs table."""
+    search.create_index()
+    count = Blog.rebuild_search_index()
+    click.echo(f'{count} blog(s) indexed')
+
+@app.cli.command('convert-timestamps')
+def convert_timestamps():
+    """
+    Convert the 'YYYY-MM-DD HH:MM:SS' timestamp strings to integer epoch seconds.
+    (run it before 'flask db migrate', otherwise the autogenerated migration casts the strings and loses the data)
+    """
+    # the strings were written with datetime.now(), so they are server local time
+    def to_epoch(column):
+        return f"CASE WHEN typeof(\"{column}\") = 'text' THEN CAST(strftime('%s', \"{column}\", 'utc') AS INTEGER) ELSE \"{column}\" END"
+
+    for model, columns in ((Blog, ('created', 'updated')), (Comment, ('created',)), (MemoryMapMarker, ('created', 'updated'))):
+        with db.engine.connect() as conn:
+            column_types = {row[1]: row[2] for row in conn.exec_driver_sql(f'PRAGMA table_info("{model.__tablename__}")')}
+        if not column_types:
+            continue
+        if all(column_types.get(column, '').upper() == 'INTEGER' for column in columns):
+            click.echo(f'{model.__tablename__}: already converted')
+            continue
+        count = rebuild_table(model, {column: to_epoch(column) for column in columns})
+        click.echo(f'{model.__tablename__}: {count} row(s) converted')
+
+@app.cli.command('compress-content')
+def compress_content():
+    """Compress the blog contents written before compression was enabled (updated times are not changed)."""
+    count = 0
+    while True:
+        rows = db.session.query(Blog.id, Blog.content).filter(func.typeof(Blog.content) == 'text').limit(200).all()
+        if not rows:
+            break
+        for id, content in rows:
+            db.session.execute(update(Blog).where(Blog.id == id).values(content=content))
+        db.session.commit()
+        count += len(rows)
+    click.echo(f'{count} blog(s) compressed')
+
+@app.cli.command('backfill-comment-counts')
+def backfill_comment_counts():
+    """Fill the denormalized reply_count and parent_name of the existing comments."""
+    # the replies of a comment are the paths in the range ('<path>.', '<path>/'), which is a scan of the path index
+    result = db.session.execute(text("""
+        UPDATE comments SET
+            reply_count = (SELECT count(*) FROM comments AS reply WHERE reply.path > comments.path || '.' AND reply.path < comments.path || '/'),
+            parent_name = (SELECT parent.name FROM comments AS parent WHERE parent.id = comments.parent_id)
+    """))
+    db.session.commit()
+    click.echo(f'{result.rowcount} comment(s) updated')
+
+@app.cli.command('backfill-comment-depth')
+def backfill_comment_depth():
+    """Fill depth and root_id of the existing comments from their paths."""
+    result = db.session.execute(text("""
+        UPDATE comments SET
+            depth = length(path) - length(replace(path, '.', '')) + 1,
+            root_id = CAST(substr(path, 1, instr(path || '.', '.') - 1) AS INTEGER)
+        WHERE depth IS NULL AND path IS NOT NULL
+    """))
+    db.session.commit()
+    click.echo(f'{result.rowcount} comment(s) updated')
+
+@app.cli.command('send-mail')
+def send_mail():
+    """Send the due messages of the mail outbox (for setups with MAIL_OUTBOX_WORKER=false, e.g. from cron)."""
+    count = outbox.send_due()
+    click.echo(f'{count} message(s) processed')
@@ -0,0 +1,33 @@
+import hashlib
+from flask import request, make_response
+from werkzeug.http import is_resource_modified, quote_etag, http_date
+
+# helpers for conditional GET (ETag / Last-Modified / 304 Not Modified)
+# decide with the cheap validators first, and only build the full body when the client copy is stale
+
+def make_etag(*parts):
+    return hashlib.sha1('|'.join(map(str, parts)).encode()).hexdigest()
+
+def not_modified(etag, last_modified=None):
+    """
+    Check If-None-Match / If-Modified-Since of the current request against the validators.
+
+    :param etag: The (unquoted) strong ETag of the current representation.
+    :param last_modified: The aware datetime of the last modification, if known.
+    :return: A 304 response if the client copy is still fresh, otherwise None.
+    """
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    response = make_response('', 304)
+    response.headers.update(validators(etag, last_modified))
+    return response
+
+def validators(etag, last_modified=None):
+    # headers to send with the 200 response, clients have to revalidate before reusing their copy
+    headers = {
+        'ETag': quote_etag(etag),
+        'Cache-Control': 'no-cache',
+    }
+    if last_modified:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
@@ -0,0 +1,8 @@
+import os
+
+# gunicorn reads this file from the working directory (the command line options override it)
+# threaded workers: a request waiting for the password hashing or thumbnail pool releases the GIL, so the other
+# threads of the worker keep serving requests (a sync worker would be blocked for the whole hash)
+worker_class = 'gthread'
+# more threads than hashing slots (PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE_SIZE), so hashing never takes all of them
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
@@ -0,0 +1,51 @@
+import threading
+from passlib.hash import pbkdf2_sha256
+from werkzeug.exceptions import ServiceUnavailable
+from pool import ProcessPool
+
+# the pbkdf2 functions run in the worker processes, they have to be importable without the flask app
+def _hash(password, rounds):
+    return pbkdf2_sha256.using(rounds=rounds).hash(password)
+
+def _verify(password, hash):
+    return pbkdf2_sha256.verify(password, hash)
+
+class HashingBusy(ServiceUnavailable):
+    description = 'Server is busy, please try again later'
+
+class HashingService:
+    """
+    Password hashing (pbkdf2_sha256) in a bounded process pool, so the CPU-bound work does not hold the request worker's GIL.
+    (at most workers + queue size hashes are in flight per gunicorn worker, further requests fail fast with HashingBusy (503).
+    the bound only matters with threaded workers, see gunicorn.conf.py, a sync worker has a single request in flight)
+    """
+
+    def __init__(self, app=None):
+        self.rounds = None
+        self._pool = ProcessPool()
+        self._slots = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.rounds = app.config.get('PASSWORD_HASH_ROUNDS', pbkdf2_sha256.default_rounds)
+        self._pool = ProcessPool(app.config.get('PASSWORD_HASH_WORKERS', 2))
+        self._slots = threading.BoundedSemaphore(self._pool.workers + app.config.get('PASSWORD_HASH_QUEUE_SIZE', 8))
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy(retry_after=1)
+        try:
+            return self._pool.run(fn, *args)
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(_hash, password, self.rounds)
+
+    def verify(self, password, hash):
+        return self._run(_verify, password, hash)
+
+    # hashes created with other parameters are replaced on the next successful login (cheap, nothing is hashed)
+    def needs_update(self, hash):
+        return pbkdf2_sha256.using(rounds=self.rounds).needs_update(hash)
@@ -1,6 +1,200 @@
-from app import db
-from passlib.hash import pbkdf2_sha256 as sha256
-from sqlalchemy import func
+import base64
+import datetime
+import hashlib
+import json
+import time
+import zlib
+import search
+from collections import namedtuple
+from app import app, db, hasher
+from cache import TTLCache
+from flask import current_app
+from sqlalchemy import exists, func, insert, literal, select, tuple_, type_coerce, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import defer, joinedload, load_only
+
+# cached COUNT(*) of the blog feeds, keyed by the 'blogs' cache generation and the author id (None for all blogs)
+_blog_total_cache = TTLCache(maxsize=app.config['BLOGS_TOTAL_CACHE_SIZE'], ttl=app.config['BLOGS_TOTAL_CACHE_TTL'])
+
+# identity of the authenticated user, resolved once per request by the user_lookup_loader (resources_user.py)
+# and cached across requests, keyed by email (saving a user invalidates it in this worker, the ttl bounds the other workers)
+UserIdentity = namedtuple('UserIdentity', ['id', 'username', 'email', 'verified'])
+_identity_cache = TTLCache(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+
+# opaque cursor for keyset pagination, the values are the sort key of the last row on the page
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode()
+
+def decode_cursor(cursor, size):
+    """
+    Decode a cursor created by encode_cursor.
+
+    :param cursor: The cursor string sent by the client.
+    :param size: The number of values the cursor must contain.
+    :return: A list with the decoded values.
+    :raises ValueError: If the cursor is malformed.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError('Invalid cursor')
+    return values
+
+def page_by_id(query, id_column, limit, cursor=None, newest_first=False):
+    """
+    Keyset pagination in id order, for the listings without a better sort key.
+
+    :param query: The query of the rows (the rows need an id attribute).
+    :param id_column: The id column to sort and filter by.
+    :param limit: Number of rows per page (already clamped by the caller).
+    :param cursor: The next_cursor returned with the previous page.
+    :param newest_first: Sort by descending id.
+    :return: A tuple (rows, has_next, next_cursor).
+    :raises ValueError: If the cursor is malformed.
+    """
+    if cursor:
+        last_id, = decode_cursor(cursor, 1)
+        if not isinstance(last_id, int):
+            raise ValueError('Invalid cursor')
+        query = query.filter(id_column < last_id if newest_first else id_column > last_id)
+    # fetch one extra row to know whether there is a next page
+    rows = query.order_by(id_column.desc() if newest_first else id_column).limit(limit + 1).all()
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+    return rows, has_next, encode_cursor(rows[-1].id) if has_next else None
+
+def iter_export(query, to_json, key=None):
+    """
+    Stream all rows of a query as json, read in batches with yield_per so the memory stays the same for any table size.
+
+    :param query: The query of the rows, in the order they are written.
+    :param to_json: Converts a row to a dictionary.
+    :param key: Write {"<key>": [...]} if given, otherwise one json object per line (NDJSON).
+    :return: A generator of json text chunks.
+    """
+    buffer = ['{%s:[' % json.dumps(key)] if key else []
+    size = 0
+    first = True
+    for row in query.yield_per(500):
+        item = json.dumps(to_json(row), ensure_ascii=False)
+        if key:
+            buffer.append(item if first else ',' + item)
+        else:
+            buffer.append(item + '\n')
+        first = False
+        size += len(item)
+        if size >= 8192:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if key:
+        buffer.append(']}')
+    yield ''.join(buffer)
+
+# timestamps are stored as integer epoch seconds (indexable, compared as numbers),
+# the api keeps sending and receiving them as server local time strings
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def now_timestamp():
+    return int(time.time())
+
+def format_timestamp(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp).strftime(TIMESTAMP_FORMAT)
+
+def parse_timestamp(value):
+    try:
+        return int(datetime.datetime.strptime(value, TIMESTAMP_FORMAT).timestamp())
+    except (TypeError, ValueError):
+        raise ValueError('Invalid time format, expected YYYY-MM-DD HH:MM:SS')
+
+# aware datetime of a timestamp (e.g. for Last-Modified)
+def to_datetime(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+# stored content starts with a version byte: raw utf-8 or zlib compressed utf-8 (the zlib stream is also a valid http 'deflate' body)
+CONTENT_RAW = b'\x00'
+CONTENT_ZLIB = b'\x01'
+# small contents are not worth compressing
+_CONTENT_COMPRESS_MIN_SIZE = 512
+
+def compress_content(content):
+    data = content.encode('utf-8')
+    if len(data) < _CONTENT_COMPRESS_MIN_SIZE:
+        return CONTENT_RAW + data
+    return CONTENT_ZLIB + zlib.compress(data, 6)
+
+def decompress_content(value):
+    # rows written before compression are plain TEXT
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    if value[:1] == CONTENT_ZLIB:
+        return zlib.decompress(value[1:]).decode('utf-8')
+    if value[:1] == CONTENT_RAW:
+        return value[1:].decode('utf-8')
+    # old TEXT cast to BLOB without a version byte
+    return value.decode('utf-8')
+
+def apply_text_patch(text, patch):
+    """
+    Apply a list of replacements to a text.
+
+    :param text: The text the patch was computed against.
+    :param patch: List of [start, end, replacement], where text[start:end] is replaced (offsets in UTF-16 code units of the original text
+        like the indices of a JavaScript string, sorted and not overlapping).
+    :return: The patched text.
+    :raises ValueError: If the patch is malformed or does not fit the text.
+    """
+    if not isinstance(patch, list):
+        raise ValueError('Invalid patch')
+    # characters outside the BMP (e.g. emoji) are two code units, the text is spliced in UTF-16
+    units = text.encode('utf-16-le')
+    length = len(units) // 2
+
+    def splits_pair(offset):
+        # an offset between the two halves of a surrogate pair
+        return 0 < offset < length and 0xDC00 <= int.from_bytes(units[offset * 2:offset * 2 + 2], 'little') <= 0xDFFF
+
+    parts = []
+    position = 0
+    try:
+        for op in patch:
+            if not isinstance(op, list) or len(op) != 3:
+                raise ValueError('Invalid patch')
+            start, end, replacement = op
+            if not isinstance(start, int) or not isinstance(end, int) or not isinstance(replacement, str) or not position <= start <= end <= length:
+                raise ValueError('Invalid patch')
+            if splits_pair(start) or splits_pair(end):
+                raise ValueError('Invalid patch')
+            parts.append(units[position * 2:start * 2])
+            parts.append(replacement.encode('utf-16-le'))
+            position = end
+        parts.append(units[position * 2:])
+        return b''.join(parts).decode('utf-16-le')
+    except UnicodeError:
+        # lone surrogates in a replacement
+        raise ValueError('Invalid patch')
+
+class CompressedText(db.TypeDecorator):
+    """
+    Text column transparently stored as a versioned (compressed) BLOB.
+    """
+    impl = db.LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return compress_content(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress_content(value)
 
 # Define the Blog model
 class Blog(db.Model):
@@ -10,19 +204,35 @@ class Blog(db.Model):
     category = db.Column(db.String(50), nullable=False)
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.String(255))
-    created = db.Column(db.String(10), nullable=False)
-    updated = db.Column(db.String(10))
+    created = db.Column(db.Integer, nullable=False)
+    updated = db.Column(db.Integer)
     # foregin key to the author table (lower case table name 'users')
     # when you are operating on the blog data, put param author='<user's name>', it would be automatically linked to users table and mapped to the author_id
     # if you want to know the author's fields (name, email, etc.), you can use the author.field_name
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     cover_image = db.Column(db.String(255), default='')
-    content = db.Column(db.Text, nullable=False)
+    # the full Tiptap html, compressed (see CompressedText)
+    content = db.Column(CompressedText, nullable=False)
+    # incremented on every update, the update fails with StaleDataError if the row was changed since it was loaded (optimistic concurrency)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     # Define a relationship with the Comment table and create a new column blog as backref
     comments = db.relationship('Comment', backref='blog')
+
+    __mapper_args__ = {'version_id_col': version}
+
+    # composite indexes matching the feed ordering, so keyset pages are index range scans
+    __table_args__ = (
+        db.Index('ix_blogs_updated_id', updated.desc(), id.desc()),
+        db.Index('ix_blogs_author_id_updated_id', author_id, updated.desc(), id.desc()),
+    )
     
     def save_to_db(self):
         db.session.add(self)
+        # flush to get the id, the search index is committed together with the blog
+        db.session.flush()
+        search.index_blog(self)
+        # invalidate the cached feed pages of every worker (committed together with the blog)
+        CacheGeneration.bump('blogs')
         db.session.commit()
     
     # private to_json method to convert the blog object to a json format
@@ -34,8 +244,8 @@ class Blog(db.Model):
                 'title': blog.title,
                 'description': blog.description,
                 'category': blog.category,
-                'created': blog.created,
-                'updated': blog.updated,
+                'created': format_timestamp(blog.created),
+                'updated': format_timestamp(blog.updated),
             },
             'author': {
                 'id': blog.author.id,
@@ -44,6 +254,7 @@ class Blog(db.Model):
             },
             'cover_image': blog.cover_image,
             'content': blog.content,
+            'version': blog.version,
         }
     
     # private to_json method to convert the blog object to a json format
@@ -55,8 +266,8 @@ class Blog(db.Model):
                 'title': blog.title,
                 'description': blog.description,
                 'category': blog.category,
-                'created': blog.created,
-                'updated': blog.updated,
+                'created': format_timestamp(blog.created),
+                'updated': format_timestamp(blog.updated),
             },
             'author': {
                 'id': blog.author.id,
@@ -67,12 +278,25 @@ class Blog(db.Model):
             # content is not required for blog list (performance optimization)
         }
 
+    @classmethod
+    def preview_query(cls):
+        # load only the columns used by preview_to_json, with the author in the same joined query (avoid N+1 and the content column)
+        return cls.query.options(
+            load_only(cls.id, cls.title, cls.description, cls.category, cls.created, cls.updated, cls.cover_image, cls.author_id),
+            joinedload(cls.author).load_only(User.id, User.username, User.email),
+        )
+
     @classmethod
     def return_all(cls):
-        return {'blogs': list(map(lambda blog: cls.preview_to_json(blog), cls.query.all()))}
+        return {'blogs': list(map(lambda blog: cls.preview_to_json(blog), cls.preview_query().all()))}
+
+    # stream the previews of every blog in id order, as {"blogs": [...]} or as NDJSON (ndjson=True)
+    @classmethod
+    def iter_all(cls, ndjson=False):
+        return iter_export(cls.preview_query().order_by(cls.id), cls.preview_to_json, key=None if ndjson else 'blogs')
     
     @classmethod
-    def get_paginated_blogs(cls, page, per_page, last_blog_id, last_blog_updated_time):
+    def get_paginated_blogs(cls, page, per_page, last_blog_id, last_blog_updated_time, author_id=None):
         """
         Get blogs sorted by updated time with pagination.
         (always use last_blog_updated_time & last_blog_id to filter blogs, and return the first page with per_page blogs)
@@ -81,12 +305,24 @@ class Blog(db.Model):
         :param per_page: Number of blogs per page.
         :param last_blog_id: The id of the last blog on the last page.
         :param last_blog_updated_time: The updated time of the last blog on the last page.
+        :param author_id: Only return blogs of this author if given.
         :return: A dictionary with paginated blogs.
+        :raises ValueError: If last_blog_updated_time is malformed.
         """
+        criteria = []
+        if author_id is not None:
+            criteria.append(cls.author_id == author_id)
         if last_blog_updated_time:
-            paginated_blogs = cls.query.filter(cls.updated <= last_blog_updated_time, cls.id != last_blog_id).order_by(cls.updated.desc()).paginate(page=page, per_page=per_page, error_out=False)
-        else:
-            paginated_blogs = cls.query.order_by(cls.updated.desc()).paginate(page=page, per_page=per_page, error_out=False)
+            last_blog_updated_time = parse_timestamp(last_blog_updated_time)
+            if last_blog_id:
+                # (updated, id) row comparison, blogs sharing the same updated time are neither dropped nor repeated
+                criteria.append(tuple_(cls.updated, cls.id) < (last_blog_updated_time, last_blog_id))
+            else:
+                criteria.append(cls.updated <= last_blog_updated_time)
+        query = cls.preview_query().filter(*criteria)
+        paginated_blogs = query.order_by(cls.updated.desc(), cls.id.desc()).paginate(page=page, per_page=per_page, error_out=False, count=False)
+        # paginate() would count a subquery of the whole entity, count the ids only
+        paginated_blogs.total = db.session.query(func.count(cls.id)).filter(*criteria).scalar()
         blogs = paginated_blogs.items
 
         return {
@@ -98,11 +334,100 @@ class Blog(db.Model):
             'has_next': paginated_blogs.has_next,
             'has_prev': paginated_blogs.has_prev,
         }
+
+    @classmethod
+    def get_blogs_by_cursor(cls, per_page, cursor=None, include_total=False, author_id=None):
+        """
+        Get blogs sorted by updated time with keyset pagination.
+        (no OFFSET and no COUNT(*), the page is read from the (updated, id) index starting after the cursor)
+
+        :param per_page: Number of blogs per page.
+        :param cursor: The next_cursor returned with the previous page, empty for the first page.
+        :param include_total: Also return the (cached) total number of blogs.
+        :param author_id: Only return blogs of this author if given.
+        :return: A dictionary with the blogs and the cursor of the next page.
+        :raises ValueError: If the cursor is malformed.
+        """
+        per_page = min(max(per_page, 1), current_app.config['BLOGS_MAX_PER_PAGE'])
+        query = cls.preview_query()
+        if author_id is not None:
+            query = query.filter_by(author_id = author_id)
+        if cursor:
+            last_updated, last_id = decode_cursor(cursor, 2)
+            if not isinstance(last_updated, int) or not isinstance(last_id, int):
+                raise ValueError('Invalid cursor')
+            query = query.filter(tuple_(cls.updated, cls.id) < (last_updated, last_id))
+        # fetch one extra row to know whether there is a next page
+        blogs = query.order_by(cls.updated.desc(), cls.id.desc()).limit(per_page + 1).all()
+        has_next = len(blogs) > per_page
+        blogs = blogs[:per_page]
+
+        result = {
+            'blogs': list(map(lambda blog: cls.preview_to_json(blog), blogs)),
+            'per_page': per_page,
+            'has_next': has_next,
+            'next_cursor': encode_cursor(blogs[-1].updated, blogs[-1].id) if has_next else None,
+        }
+        if include_total:
+            result['total'] = cls.count_blogs(author_id)
+        return result
+
+    @classmethod
+    def count_blogs(cls, author_id=None):
+        # the total is only informative for the feed, so it is cached instead of counted on every page
+        # (creating, updating or deleting a blog bumps the generation, in every worker)
+        key = (CacheGeneration.current('blogs'), author_id)
+        total = _blog_total_cache.get(key)
+        if total is None:
+            query = db.session.query(func.count(cls.id))
+            if author_id is not None:
+                query = query.filter(cls.author_id == author_id)
+            total = query.scalar()
+            _blog_total_cache.set(key, total)
+        return total
+    
+    @classmethod
+    def search_blogs(cls, query, page, per_page):
+        """
+        Full-text search over title, description and content, best matches first.
+
+        :param query: The search words.
+        :param page: The page number (1-indexed).
+        :param per_page: Number of blogs per page.
+        :return: A dictionary with the matched blog previews and their snippets.
+        """
+        page = max(page, 1)
+        per_page = min(max(per_page, 1), current_app.config['BLOGS_MAX_PER_PAGE'])
+        # fetch one extra hit to know whether there is a next page
+        hits = search.match(query, limit=per_page + 1, offset=(page - 1) * per_page)
+        has_next = len(hits) > per_page
+        hits = hits[:per_page]
+        blogs = {blog.id: blog for blog in cls.preview_query().filter(cls.id.in_([id for id, _ in hits]))}
+
+        results = []
+        for id, snippet in hits:
+            if id in blogs:
+                blog_json = cls.preview_to_json(blogs[id])
+                blog_json['snippet'] = snippet
+                results.append(blog_json)
+        return {
+            'blogs': results,
+            'current_page': page,
+            'per_page': per_page,
+            'has_next': has_next,
+        }
+
+    @classmethod
+    def rebuild_search_index(cls):
+        rows = db.session.query(cls.id, cls.title, cls.description, cls.content).yield_per(500)
+        return search.rebuild_index(rows)
     
     @classmethod
     def delete_all(cls):
         try:
             num_rows_deleted = db.session.query(cls).delete()
+            search.clear_index()
+            CacheGeneration.bump('blogs')
             db.session.commit()
             return {'message': f'{num_rows_deleted} row(s) deleted'}
         except:
@@ -116,34 +441,185 @@ class Blog(db.Model):
         else:
             return the_blog
     
+    def apply_changes(self, changes, content_patch=None, content_sha256=None):
+        """
+        Apply a partial update to the blog (not saved), the updated time is only changed if a value actually changed.
+
+        :param changes: New values of the changed fields (category, title, description, cover_image, content).
+        :param content_patch: Optional patch of the content, see apply_text_patch.
+        :param content_sha256: Optional sha256 hex digest of the patched content (UTF-8) computed by the client.
+        :return: True if something changed.
+        :raises ValueError: If the content patch does not apply or the patched content does not match content_sha256.
+        """
+        changes = dict(changes)
+        if content_patch is not None:
+            changes['content'] = apply_text_patch(changes.get('content', self.content), content_patch)
+            # the client and the server applied the patch to different texts, nothing is saved
+            if content_sha256 is not None and hashlib.sha256(changes['content'].encode('utf-8')).hexdigest() != content_sha256.lower():
+                raise ValueError('Patched content does not match content_sha256')
+        changed = False
+        for field, value in changes.items():
+            if getattr(self, field) != value:
+                setattr(self, field, value)
+                changed = True
+        if changed:
+            self.updated = now_timestamp()
+        return changed
+
+    # the content as stored in the database (versioned bytes, or str for rows written before compression), without decompressing it
+    @classmethod
+    def find_stored_content(cls, id):
+        return db.session.query(type_coerce(cls.content, db.LargeBinary)).filter_by(id = id).scalar()
+
+    # only the validators of a blog (primary key lookup, the content column is not loaded)
+    @classmethod
+    def find_version(cls, id):
+        return db.session.query(cls.id, cls.updated, cls.version).filter_by(id = id).first()
+
+    @classmethod
+    def find_author_id(cls, id):
+        return db.session.query(cls.author_id).filter_by(id = id).scalar()
+    
     @classmethod
     def delete_by_id(cls, id):
         try:
             num_rows_deleted = cls.query.filter_by(id = id).delete()
             Comment.query.filter_by(blog_id = id).delete()
+            search.remove_blog(id)
+            CacheGeneration.bump('blogs')
+            CacheGeneration.bump(f'comments:{id}')
             db.session.commit()
             return {'message': f'{num_rows_deleted} row(s) deleted'}
         except:
             return {'message': 'Something went wrong'}
         
-    # Function to count the number of parts in a split string by '.'
-    @classmethod
-    def _count_parts(cls, column, delimiter='.'):
-        return func.length(column) - func.length(func.replace(column, delimiter, '')) + 1
-    
     @classmethod
     def get_comments(cls, blogId):
-        # Filter comments with len(comment['path'].split('.')) == 1
-        comments = Comment.query.filter(Comment.blog_id == blogId).filter(cls._count_parts(Comment.path) == 1).order_by(Comment.id.desc()).all()
-        # filtered_comments = [comment for comment in comments if len(comment.path.split('.')) == 1]
+        # top-level comments (depth 1), newest first, read from the (blog_id, depth, id) index
+        comments = Comment.query.filter(Comment.blog_id == blogId, Comment.depth == 1).order_by(Comment.id.desc()).all()
         return {'comments': list(map(lambda comment: comment.to_json(), comments))}
     
     @classmethod
     def get_comment_replies(cls, blogId, commentPath):
-        # filter replies for a specific comment under blogId, and order them by their path and id in ascending order
-        replies = Comment.query.filter(Comment.blog_id == blogId).filter(Comment.path.startswith(commentPath)).filter(cls._count_parts(Comment.path) > 1).order_by(Comment.path, Comment.id).all()
+        # the whole reply subtree of a comment ordered by path, a range scan of the (blog_id, path) index
+        replies = Comment.query.filter(Comment.blog_id == blogId, Comment.path > commentPath + '.', Comment.path < commentPath + '/').order_by(Comment.path).all()
         return {'replies': list(map(lambda reply: reply.to_json(), replies))}
 
+    @classmethod
+    def iter_comment_tree(cls, blogId, max_depth=None):
+        """
+        Stream the comment tree of a blog as json: {"comments": [{...comment, "replies": [...]}, ...]}, oldest first.
+        (one ordered scan of the (blog_id, path) index, the path order is depth first so the nesting is written while reading, in linear time)
+
+        :param blogId: The id of the blog.
+        :param max_depth: Only include comments up to this level (1 for top-level comments only).
+        :return: A generator of json text chunks.
+        """
+        query = Comment.query.filter(Comment.blog_id == blogId)
+        if max_depth:
+            query = query.filter(Comment.depth <= max_depth)
+        query = query.order_by(Comment.path).yield_per(500)
+
+        buffer = ['{"comments":[']
+        size = 0
+        # depths of the comments whose replies array is still open
+        open_depths = []
+        first = True
+        for comment in query:
+            depth = comment.level()
+            # close the comments that are not ancestors of this one
+            while open_depths and open_depths[-1] >= depth:
+                buffer.append(']}')
+                open_depths.pop()
+                first = False
+            node = json.dumps(comment.to_json(), ensure_ascii=False)
+            # reopen the object to append the replies array
+            buffer.append(('' if first else ',') + node[:-1] + ',"replies":[')
+            open_depths.append(depth)
+            first = True
+            size += len(node)
+            if size >= 8192:
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+        buffer.append(']}' * len(open_depths))
+        buffer.append(']}')
+        yield ''.join(buffer)
+
+    @classmethod
+    def get_comments_page(cls, blogId, limit, cursor=None):
+        """
+        Get top-level comments of a blog, newest first, with cursor pagination.
+        (the page is a range scan of the (blog_id, depth, id) index)
+
+        :param blogId: The id of the blog.
+        :param limit: Number of comments per page.
+        :param cursor: The next_cursor returned with the previous page.
+        :return: A dictionary with the comments and the cursor of the next page.
+        :raises ValueError: If the cursor is malformed.
+        """
+        limit = min(max(limit, 1), current_app.config['COMMENTS_MAX_PER_PAGE'])
+        query = Comment.query.filter(Comment.blog_id == blogId, Comment.depth == 1)
+        if cursor:
+            last_id, = decode_cursor(cursor, 1)
+            if not isinstance(last_id, int):
+                raise ValueError('Invalid cursor')
+            query = query.filter(Comment.id < last_id)
+        # fetch one extra row to know whether there is a next page
+        comments = query.order_by(Comment.id.desc()).limit(limit + 1).all()
+        has_next = len(comments) > limit
+        comments = comments[:limit]
+        return {
+            'comments': list(map(lambda comment: comment.to_json(), comments)),
+            'has_next': has_next,
+            'next_cursor': encode_cursor(comments[-1].id) if has_next else None,
+        }
+
+    @classmethod
+    def get_comment_replies_page(cls, blogId, commentPath, limit, cursor=None, max_depth=None):
+        """
+        Get the reply subtree of a comment in path order (depth first), with cursor pagination and an optional depth limit.
+        (the replies of a comment are the paths in the range ('<path>.', '<path>/'), a range scan of the (blog_id, path) index)
+
+        :param blogId: The id of the blog.
+        :param commentPath: The path of the comment.
+        :param limit: Number of replies per page.
+        :param cursor: The next_cursor of the previous page, or the replies_cursor of a reply to load its subtree instead.
+        :param max_depth: Only return replies up to this many levels below the subtree root.
+        :return: A dictionary with the replies and the cursor of the next page.
+        :raises ValueError: If the cursor is malformed or outside of the comment.
+        """
+        limit = min(max(limit, 1), current_app.config['COMMENTS_MAX_PER_PAGE'])
+        root_path, last_path = commentPath, commentPath
+        if cursor:
+            root_path, last_path = decode_cursor(cursor, 2)
+            if not isinstance(root_path, str) or not isinstance(last_path, str) or last_path < root_path:
+                raise ValueError('Invalid cursor')
+            # a cursor may point into the subtree of a reply, but never outside of the requested comment
+            if root_path != commentPath and not root_path.startswith(commentPath + '.'):
+                raise ValueError('Invalid cursor')
+
+        query = Comment.query.filter(Comment.blog_id == blogId, Comment.path > max(root_path + '.', last_path), Comment.path < root_path + '/')
+        max_level = len(root_path.split('.')) + max_depth if max_depth else None
+        if max_level:
+            query = query.filter(Comment.depth <= max_level)
+        replies = query.order_by(Comment.path).limit(limit + 1).all()
+        has_next = len(replies) > limit
+        replies = replies[:limit]
+
+        replies_json = []
+        for reply in replies:
+            reply_json = reply.to_json()
+            # the replies of this node were cut by the depth limit, its replies_cursor loads them
+            if max_level and reply.depth == max_level and reply.reply_count:
+                reply_json['replies_cursor'] = encode_cursor(reply.path, reply.path)
+            replies_json.append(reply_json)
+        return {
+            'replies': replies_json,
+            'has_next': has_next,
+            'next_cursor': encode_cursor(root_path, replies[-1].path) if has_next else None,
+        }
+
     
 # Define the Author model
 class User(db.Model):
@@ -162,86 +638,92 @@ class User(db.Model):
     def save_to_db(self):
         db.session.add(self)
         db.session.commit()
+        _identity_cache.pop(self.email)
 
     @classmethod
     def find_by_email(cls, email):
         return cls.query.filter_by(email = email).first()
+
+    @classmethod
+    def find_identity(cls, email):
+        """
+        Find the (id, username, email, verified) of a user, cached for USER_CACHE_TTL seconds.
+
+        :param email: The email of the user (the JWT identity).
+        :return: A UserIdentity, or None if there is no such user.
+        """
+        identity = _identity_cache.get(email)
+        if identity is None:
+            row = db.session.query(cls.id, cls.username, cls.email, cls.verified).filter_by(email = email).first()
+            if row is None:
+                return None
+            identity = UserIdentity(*row)
+            _identity_cache.set(email, identity)
+        return identity
     
+    @classmethod
+    def list_to_json(cls, user):
+        return {
+            'id': user.id,
+            'username': user.username,
+            'email': user.email,
+        }
+
+    @classmethod
+    def list_query(cls):
+        # plain rows of the listed columns, nothing is kept in the session while streaming
+        return db.session.query(cls.id, cls.username, cls.email)
+
     @classmethod
     def return_all(cls):
-        def to_json(x):
-            return {
-                'id': x.id,
-                'username': x.username,
-                'email': x.email,
-            }
+        return {'users': list(map(lambda x: cls.list_to_json(x), cls.list_query().all()))}
 
-        return {'users': list(map(lambda x: to_json(x), User.query.all()))}
+    # stream every user, as {"users": [...]} or as NDJSON (ndjson=True)
+    @classmethod
+    def iter_all(cls, ndjson=False):
+        return iter_export(cls.list_query().order_by(cls.id), cls.list_to_json, key=None if ndjson else 'users')
+
+    @classmethod
+    def get_users_page(cls, limit, cursor=None):
+        """
+        Get users in id order with keyset pagination.
+
+        :param limit: Number of users per page.
+        :param cursor: The next_cursor returned with the previous page.
+        :return: A dictionary with the users and the cursor of the next page.
+        :raises ValueError: If the cursor is malformed.
+        """
+        limit = min(max(limit, 1), current_app.config['USERS_MAX_PER_PAGE'])
+        users, has_next, next_cursor = page_by_id(cls.list_query(), cls.id, limit, cursor)
+        return {
+            'users': list(map(lambda x: cls.list_to_json(x), users)),
+            'has_next': has_next,
+            'next_cursor': next_cursor,
+        }
     
     @classmethod
     def delete_all(cls):
         try:
             num_rows_deleted = db.session.query(cls).delete()
             db.session.commit()
+            _identity_cache.clear()
             return {'message': f'{num_rows_deleted} row(s) deleted'}
         except:
             return {'message': 'Something went wrong'}
     
-    # return all blogs of a specific user
-    def return_blogs(self, page, per_page, last_blog_id, last_blog_updated_time):
-        """
-        Get blogs sorted by updated time with pagination.
-        (always use last_blog_updated_time & last_blog_id to filter blogs, and return the first page with per_page blogs)
-
-        :param page: The page number (1-indexed).
-        :param per_page: Number of blogs per page.
-        :param last_blog_id: The id of the last blog on the last page.
-        :param last_blog_updated_time: The updated time of the last blog on the last page.
-        :return: A dictionary with paginated blogs.
-        """
-        if last_blog_updated_time:
-            paginated_blogs = Blog.query.filter_by(author_id = self.id).filter(Blog.updated <= last_blog_updated_time, Blog.id != last_blog_id).order_by(Blog.updated.desc()).paginate(page=page, per_page=per_page, error_out=False)
-        else:
-            paginated_blogs = Blog.query.filter_by(author_id = self.id).order_by(Blog.updated.desc()).paginate(page=page, per_page=per_page, error_out=False)
-        blogs = paginated_blogs.items
-
-        # return all attributes of the blogs except content (performance optimization)
-        def to_json(blog):
-            return {
-                'id': blog.id,
-                'attributes': {
-                    'title': blog.title,
-                    'description': blog.description,
-                    'category': blog.category,
-                    'created': blog.created,
-                    'updated': blog.updated,
-                },
-                'author': {
-                    'id': blog.author.id,
-                    'name': blog.author.username,
-                    'email': blog.author.email,
-                },
-                'cover_image': blog.cover_image,
-                # content is not required for blog list (performance optimization)
-            }
-        
-        return {
-            'blogs': list(map(lambda blog: to_json(blog), blogs)),
-            'total': paginated_blogs.total,
-            'pages': paginated_blogs.pages,
-            'current_page': paginated_blogs.page,
-            'per_page': paginated_blogs.per_page,
-            'has_next': paginated_blogs.has_next,
-            'has_prev': paginated_blogs.has_prev,
-        }
-        
+    # hashing runs in the process pool of hashing.py, raises HashingBusy (503) when it is saturated
     @staticmethod
     def generate_hash(password):
-        return sha256.hash(password)
+        return hasher.hash(password)
 
     @staticmethod
     def verify_hash(password, hash):
-        return sha256.verify(password, hash)
+        return hasher.verify(password, hash)
+
+    # true if the hash was created with other parameters (e.g. rounds) than the configured ones
+    @staticmethod
+    def needs_rehash(hash):
+        return hasher.needs_update(hash)
     
 class Image(db.Model):
     __tablename__ = 'images'
@@ -250,6 +732,19 @@ class Image(db.Model):
     name = db.Column(db.String(100), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     image_url = db.Column(db.String(255), nullable=False)
+    # sha256 of the file, uploads of the same content share one stored object and its variants
+    content_hash = db.Column(db.String(64), nullable=True, index=True)
+    # key of the stored object (content-addressed: 'blog-images/<sha256><ext>', presigned uploads: 'blog-images/<email>/<date>_<uuid><ext>')
+    storage_key = db.Column(db.String(255), nullable=True, index=True)
+    # number of uploads of this content by the user, the row is deleted when the last one is released
+    ref_count = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # resized variants: {'webp': {'<width>': url, ...}, 'jpeg': {...}}
+    variants = db.Column(db.JSON(none_as_null=True), nullable=True)
+
+    __table_args__ = (
+        # the image library of a user, newest first
+        db.Index('ix_images_user_id_id', user_id, id.desc()),
+    )
 
     def save_to_db(self):
         db.session.add(self)
@@ -257,21 +752,152 @@ class Image(db.Model):
 
     # private to_json method to convert the blog object to a json format
     @classmethod
-    def __to_json(cls, image):
-        return {
+    def __to_json(cls, image, include_variants=True):
+        result = {
             'id': image.id,
             'name': image.name,
+            # no email, image listings are not limited to the owner
             'user': {
                 'id': image.user.id,
                 'username': image.user.username,
-                'email': image.user.email,
             },
             'image_url': image.image_url,
         }
+        if include_variants:
+            result['variants'] = image.variants
+        return result
     
+    @classmethod
+    def find_by_id(cls, id):
+        return cls.query.filter_by(id = id).first()
+
+    # an image with this content, of the given user if user_id is given (None if there is none)
+    @classmethod
+    def find_by_content(cls, content_hash, user_id=None):
+        query = cls.query.filter(cls.content_hash == content_hash)
+        if user_id is not None:
+            query = query.filter(cls.user_id == user_id)
+        return query.order_by(cls.id).first()
+
+    @classmethod
+    def create_for_key(cls, name, user_id, image_url, storage_key):
+        """
+        Record an image uploaded with a presigned url, once per storage key.
+
+        :return: False if an image with this storage key already exists (nothing is inserted).
+        """
+        # a single INSERT ... SELECT, SQLite serializes the writers so two confirmations cannot both insert
+        values = select(literal(name), literal(user_id), literal(image_url), literal(storage_key), literal(1)).where(
+            ~exists().where(cls.storage_key == storage_key)
+        )
+        try:
+            result = db.session.execute(insert(cls).from_select(['name', 'user_id', 'image_url', 'storage_key', 'ref_count'], values))
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+        return result.rowcount == 1
+
+    @classmethod
+    def add_reference(cls, id):
+        cls.query.filter_by(id = id).update({cls.ref_count: cls.ref_count + 1}, synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def save_batch(cls, new_images, references):
+        """
+        Insert the new images and add the references to existing ones in one transaction.
+
+        :param new_images: The Image objects to insert.
+        :param references: Number of added references by image id.
+        """
+        try:
+            db.session.add_all(new_images)
+            for id, count in references.items():
+                cls.query.filter_by(id = id).update({cls.ref_count: cls.ref_count + count}, synchronize_session=False)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+    @classmethod
+    def release(cls, image):
+        """
+        Drop one reference to an image, the row is deleted with the last one.
+
+        :param image: The image to release.
+        :return: True if the stored object is not used by any image anymore (the caller deletes it).
+        """
+        if image.ref_count > 1:
+            cls.query.filter_by(id = image.id).update({cls.ref_count: cls.ref_count - 1}, synchronize_session=False)
+            db.session.commit()
+            return False
+        db.session.delete(image)
+        db.session.flush()
+        # objects of the images uploaded before content addressing are not shared, they have no content hash
+        still_used = image.content_hash is not None and db.session.query(cls.id).filter(cls.content_hash == image.content_hash).first() is not None
+        db.session.commit()
+        return not still_used
+
+    # variants already rendered for an image with the same content, None if there are none
+    @classmethod
+    def find_variants(cls, content_hash):
+        return db.session.query(cls.variants).filter(cls.content_hash == content_hash, cls.variants.isnot(None)).limit(1).scalar()
+
+    @classmethod
+    def list_query(cls):
+        # the user of every image in the same joined query
+        return cls.query.options(joinedload(cls.user).load_only(User.id, User.username))
+
     @classmethod
     def return_all(cls):
-        return {'images': list(map(lambda image: cls.__to_json(image), cls.query.all()))}
+        return {'images': list(map(lambda image: cls.__to_json(image), cls.list_query().all()))}
+
+    # stream every image, as {"images": [...]} or as NDJSON (ndjson=True)
+    @classmethod
+    def iter_all(cls, ndjson=False):
+        return iter_export(cls.list_query().order_by(cls.id), cls.__to_json, key=None if ndjson else 'images')
+
+    @classmethod
+    def get_images_page(cls, limit, cursor=None):
+        """
+        Get images in id order with keyset pagination.
+
+        :param limit: Number of images per page.
+        :param cursor: The next_cursor returned with the previous page.
+        :return: A dictionary with the images and the cursor of the next page.
+        :raises ValueError: If the cursor is malformed.
+        """
+        limit = min(max(limit, 1), current_app.config['IMAGES_MAX_PER_PAGE'])
+        images, has_next, next_cursor = page_by_id(cls.list_query(), cls.id, limit, cursor)
+        return {
+            'images': list(map(lambda image: cls.__to_json(image), images)),
+            'has_next': has_next,
+            'next_cursor': next_cursor,
+        }
+
+    @classmethod
+    def get_user_images_page(cls, user_id, limit, cursor=None, include_variants=False):
+        """
+        Get the images of a user, newest first, with keyset pagination (read from the (user_id, id) index).
+
+        :param user_id: The id of the user.
+        :param limit: Number of images per page.
+        :param cursor: The next_cursor returned with the previous page.
+        :param include_variants: Also return the urls of the resized variants (not loaded otherwise).
+        :return: A dictionary with the images and the cursor of the next page.
+        :raises ValueError: If the cursor is malformed.
+        """
+        limit = min(max(limit, 1), current_app.config['IMAGES_MAX_PER_PAGE'])
+        query = cls.list_query().filter(cls.user_id == user_id)
+        if not include_variants:
+            query = query.options(defer(cls.variants))
+        images, has_next, next_cursor = page_by_id(query, cls.id, limit, cursor, newest_first=True)
+        return {
+            'images': list(map(lambda image: cls.__to_json(image, include_variants), images)),
+            'has_next': has_next,
+            'next_cursor': next_cursor,
+        }
 
 class Comment(db.Model):
     __tablename__ = 'comments'
@@ -285,12 +911,24 @@ class Comment(db.Model):
     name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(100), nullable=False)
     content = db.Column(db.Text, nullable=False)
-    created = db.Column(db.String(10), nullable=False, index=True)
+    created = db.Column(db.Integer, nullable=False, index=True)
     path = db.Column(db.Text, index=True)
     parent_id = db.Column(db.Integer, db.ForeignKey('comments.id'))
+    # denormalized for listing: number of replies in the whole subtree, and the name of the parent comment
+    reply_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    parent_name = db.Column(db.String(100))
+    # level of the comment (1 for top-level comments) and the id of its top-level comment, filled by save_to_db
+    depth = db.Column(db.Integer)
+    root_id = db.Column(db.Integer)
     replies = db.relationship(
         'Comment', backref=db.backref('parent', remote_side=[id]),
         lazy='dynamic')
+
+    # comment lists are range scans over the top-level comments or the paths of one blog
+    __table_args__ = (
+        db.Index('ix_comments_blog_id_depth_id', blog_id, depth, id),
+        db.Index('ix_comments_blog_id_path', blog_id, path),
+    )
     
     def to_json(self):
         return {
@@ -299,30 +937,101 @@ class Comment(db.Model):
             'name': self.name,
             'email': self.email,
             'content': self.content,
-            'created': self.created,
+            'created': format_timestamp(self.created),
             'path': self.path,
             'level': self.level(),
             'parent_id': self.parent_id,
-            'parent_name': self.parent.name if self.parent else None,
-            'replyNum': self.get_comment_replies_num(),
+            'parent_name': self.parent_name,
+            'replyNum': self.reply_count,
         }
 
     def save_to_db(self):
         db.session.add(self)
-        db.session.commit()
         if not self.path:
+            self.depth = self.parent.level() + 1 if self.parent else 1
+            if self.parent:
+                self.parent_name = self.parent.name
+            # flush to get the id, the path is set in the same transaction so no reader ever sees a comment without path
+            db.session.flush()
             prefix = self.parent.path + '.' if self.parent else ''
             self.path = prefix + '{:0{}d}'.format(self.id, self._N)
-            db.session.commit()
+            self.root_id = int(self.path.split('.')[0])
+            # one more reply in the subtree of every ancestor
+            Comment.query.filter(Comment.id.in_(Comment._ancestor_ids(self.path))).update({Comment.reply_count: Comment.reply_count + 1}, synchronize_session=False)
+        # invalidate the cached comment lists of the blog
+        CacheGeneration.bump(f'comments:{self.blog_id}')
+        db.session.commit()
 
     def level(self):
+        if self.depth:
+            return self.depth
         if self.path:
             # level starts from 1, which represents the indentation of the comment
             return len(self.path.split('.'))
         return None
 
-    def get_comment_replies_num(self):
-        return Comment.query.filter(Comment.path.startswith(self.path + '.')).count()
+    # ids of the ancestors of a comment, read from its path
+    @classmethod
+    def _ancestor_ids(cls, path):
+        return [int(part) for part in path.split('.')[:-1]]
+
+    @classmethod
+    def bulk_insert(cls, blogId, threads):
+        """
+        Import comment threads into a blog in one transaction.
+
+        :param blogId: The id of the blog.
+        :param threads: List of top-level comments, each a dict with name, email, content, optional created ('YYYY-MM-DD HH:MM:SS') and optional replies (a list with the same structure).
+        :return: The number of inserted comments.
+        :raises ValueError: If a comment is malformed (nothing is committed, the caller rolls back the session).
+        """
+        if not isinstance(threads, list):
+            raise ValueError('Invalid comments')
+        now = now_timestamp()
+        inserted = []
+        # insert level by level, one flush gets the ids of a whole level
+        level = [(None, thread) for thread in threads]
+        depth = 1
+        while level:
+            new_comments = []
+            for parent, data in level:
+                if not isinstance(data, dict) or not all(isinstance(data.get(field), str) for field in ('name', 'email', 'content')):
+                    raise ValueError('Invalid comment, name, email and content are required')
+                comment = cls(
+                    blog_id=blogId,
+                    parent_id=parent.id if parent else None,
+                    parent_name=parent.name if parent else None,
+                    name=data['name'],
+                    email=data['email'],
+                    content=data['content'],
+                    created=parse_timestamp(data['created']) if data.get('created') else now,
+                    depth=depth,
+                )
+                new_comments.append((parent, comment, data.get('replies') or []))
+            db.session.add_all([comment for _, comment, _ in new_comments])
+            db.session.flush()
+
+            level = []
+            for parent, comment, replies in new_comments:
+                comment.path = (parent.path + '.' if parent else '') + '{:0{}d}'.format(comment.id, cls._N)
+                comment.root_id = parent.root_id if parent else comment.id
+                inserted.append(comment)
+                if not isinstance(replies, list):
+                    raise ValueError('Invalid replies')
+                level.extend((comment, reply) for reply in replies)
+            depth += 1
+
+        # every comment counts once in the reply count of each of its ancestors
+        reply_counts = {}
+        for comment in inserted:
+            for ancestor_id in cls._ancestor_ids(comment.path):
+                reply_counts[ancestor_id] = reply_counts.get(ancestor_id, 0) + 1
+        for comment in inserted:
+            comment.reply_count = reply_counts.get(comment.id, 0)
+
+        CacheGeneration.bump(f'comments:{blogId}')
+        db.session.commit()
+        return len(inserted)
 
     @classmethod
     def find_by_id(cls, id):
@@ -331,7 +1040,12 @@ class Comment(db.Model):
     @classmethod
     def delete_by_path(cls, commentPath):
         try:
-            num_rows_deleted = cls.query.filter(Comment.path.startswith(commentPath)).delete()
+            blog_id = db.session.query(cls.blog_id).filter_by(path=commentPath).scalar()
+            # the comment and its replies, a range scan of the (blog_id, path) index
+            num_rows_deleted = cls.query.filter(cls.blog_id == blog_id, cls.path >= commentPath, cls.path < commentPath + '/').delete()
+            # the whole subtree is gone from the reply counts of the ancestors
+            cls.query.filter(cls.id.in_(cls._ancestor_ids(commentPath))).update({cls.reply_count: cls.reply_count - num_rows_deleted}, synchronize_session=False)
+            CacheGeneration.bump(f'comments:{blog_id}')
             db.session.commit()
             return {'message': f'{num_rows_deleted} row(s) deleted'}
         except:
@@ -347,8 +1061,8 @@ class MemoryMapMarker(db.Model):
     longitude = db.Column(db.Float, nullable=False)
     latitude = db.Column(db.Float, nullable=False)
     images = db.Column(db.Text)
-    created = db.Column(db.String(10), nullable=False)
-    updated = db.Column(db.String(10))
+    created = db.Column(db.Integer, nullable=False)
+    updated = db.Column(db.Integer)
 
     def save_to_db(self):
         db.session.add(self)
@@ -363,8 +1077,8 @@ class MemoryMapMarker(db.Model):
             'longitude': marker.longitude,
             'latitude': marker.latitude,
             'images': marker.images,
-            'created': marker.created,
-            'updated': marker.updated,
+            'created': format_timestamp(marker.created),
+            'updated': format_timestamp(marker.updated),
             'user': {
                 'id': marker.user.id,
                 'username': marker.user.username,
@@ -390,4 +1104,190 @@ class MemoryMapMarker(db.Model):
 
     @classmethod
     def return_all_with_user_id(cls, user_id):
-        return {'markers': list(map(lambda marker: cls.to_json(marker), cls.query.filter_by(user_id=user_id).all()))}
\ No newline at end of file
+        return {'markers': list(map(lambda marker: cls.to_json(marker), cls.query.filter_by(user_id=user_id).all()))}
+
+# shared generation counters for the in-process caches, bumping a generation invalidates the cache in every gunicorn worker
+class CacheGeneration(db.Model):
+    __tablename__ = 'cache_generations'
+
+    name = db.Column(db.String(50), primary_key=True)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def current(cls, name):
+        generation = db.session.query(cls.generation).filter_by(name=name).scalar()
+        return generation or 0
+
+    # the bump is part of the current transaction, call it before committing the change it invalidates
+    @classmethod
+    def bump(cls, name):
+        stmt = sqlite_insert(cls).values(name=name, generation=1)
+        stmt = stmt.on_conflict_do_update(index_elements=[cls.name], set_={'generation': cls.generation + 1})
+        db.session.execute(stmt)
+
+
+class MailOutbox(db.Model):
+    """
+    Emails waiting to be sent by the background sender (see outbox.py), so requests do not wait for SMTP.
+    (status: pending -> sending -> sent, or back to pending with a backoff when sending fails, failed after the last attempt)
+    """
+    __tablename__ = 'mail_outbox'
+    __table_args__ = (
+        db.Index('ix_mail_outbox_status_next_attempt', 'status', 'next_attempt'),
+        # at most one queued message per dedup key, repeated requests replace its content
+        db.Index('uq_mail_outbox_queued_dedup_key', 'dedup_key', unique=True, sqlite_where=db.text("status IN ('pending', 'sending')")),
+        db.Index('ix_mail_outbox_dedup_key_sent', 'dedup_key', 'sent'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    dedup_key = db.Column(db.String(200), nullable=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending', server_default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # pending: when to (re)try, sending: when the claim expires (the worker sending it died)
+    next_attempt = db.Column(db.Integer, nullable=False)
+    created = db.Column(db.Integer, nullable=False)
+    sent = db.Column(db.Integer, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+    @classmethod
+    def enqueue(cls, recipient, subject, html, dedup_key=None):
+        """
+        Queue an email, committed right away.
+
+        :param dedup_key: Messages with the same key (e.g. 'verify:<email>') are sent once, a queued one gets the new content
+            and one sent within MAIL_DEDUP_WINDOW seconds makes the new one a no-op.
+        :return: True if the message is queued, False if it was dropped as a duplicate.
+        """
+        now = now_timestamp()
+        if dedup_key:
+            window = current_app.config['MAIL_DEDUP_WINDOW']
+            recent = db.session.query(cls.id).filter(
+                cls.dedup_key == dedup_key, cls.status == 'sent', cls.sent >= now - window,
+            ).first()
+            if recent:
+                return False
+        stmt = sqlite_insert(cls).values(dedup_key=dedup_key, recipient=recipient, subject=subject, html=html,
+                                         status='pending', attempts=0, next_attempt=now, created=now)
+        if dedup_key:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[cls.dedup_key],
+                index_where=cls.status.in_(('pending', 'sending')),
+                set_={'recipient': recipient, 'subject': subject, 'html': html},
+            )
+        db.session.execute(stmt)
+        db.session.commit()
+        return True
+
+    @classmethod
+    def claim_due(cls, limit):
+        """
+        Mark the due messages as sending, a single UPDATE so two workers never claim the same row.
+        (expired claims are due again, so messages of a killed worker are retried)
+
+        :return: The claimed rows (id, recipient, subject, html, attempts).
+        """
+        now = now_timestamp()
+        due = select(cls.id).where(
+            cls.status.in_(('pending', 'sending')), cls.next_attempt <= now,
+        ).order_by(cls.next_attempt, cls.id).limit(limit).scalar_subquery()
+        rows = db.session.execute(
+            update(cls)
+            .where(cls.id.in_(due), cls.status.in_(('pending', 'sending')), cls.next_attempt <= now)
+            .values(status='sending', next_attempt=now + current_app.config['MAIL_OUTBOX_CLAIM_TIMEOUT'])
+            .returning(cls.id, cls.recipient, cls.subject, cls.html, cls.attempts)
+        ).all()
+        db.session.commit()
+        return rows
+
+    @classmethod
+    def mark_sent(cls, ids):
+        if not ids:
+            return
+        db.session.execute(update(cls).where(cls.id.in_(ids)).values(status='sent', sent=now_timestamp(), last_error=None))
+        db.session.commit()
+
+    @classmethod
+    def mark_failed(cls, rows, error):
+        # exponential backoff: MAIL_OUTBOX_RETRY_DELAY, then twice as long for every further attempt
+        now = now_timestamp()
+        max_attempts = current_app.config['MAIL_OUTBOX_MAX_ATTEMPTS']
+        delay = current_app.config['MAIL_OUTBOX_RETRY_DELAY']
+        for row in rows:
+            attempts = row.attempts + 1
+            db.session.execute(update(cls).where(cls.id == row.id).values(
+                status='failed' if attempts >= max_attempts else 'pending',
+                attempts=attempts,
+                next_attempt=now + delay * 2 ** (attempts - 1),
+                last_error=error,
+            ))
+        db.session.commit()
+
+    # give claimed messages back without counting an attempt
+    @classmethod
+    def release(cls, ids):
+        if not ids:
+            return
+        db.session.execute(update(cls).where(cls.id.in_(ids)).values(status='pending', next_attempt=now_timestamp()))
+        db.session.commit()
+
+
+# token buckets of the rate limiter (see ratelimit.py), in a database file of their own ('ratelimit' bind)
+# so the writes of every throttled request do not lock the main database
+class RateLimitBucket(db.Model):
+    __bind_key__ = 'ratelimit'
+    __tablename__ = 'rate_limit_buckets'
+
+    key = db.Column(db.String(200), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    # epoch seconds (with fractions) of the last refill
+    updated = db.Column(db.Float, nullable=False, index=True)
+    allowed = db.Column(db.Boolean, nullable=False)
+
+    @classmethod
+    def take(cls, key, capacity, rate, now):
+        """
+        Refill the bucket for the elapsed time and take one token, a single upsert so it holds across workers.
+
+        :param key: The bucket key (e.g. 'signin:ip:<ip>').
+        :param capacity: The maximum number of tokens (the burst size).
+        :param rate: Refilled tokens per second.
+        :param now: The current time (epoch seconds).
+        :return: A tuple (allowed, tokens left).
+        """
+        # the SET expressions all read the values before the update
+        refilled = func.min(capacity, cls.tokens + (now - cls.updated) * rate)
+        stmt = sqlite_insert(cls).values(key=key, tokens=capacity - 1, updated=now, allowed=True)
+        stmt = stmt.on_conflict_do_update(index_elements=[cls.key], set_={
+            'tokens': db.case((refilled >= 1, refilled - 1), else_=refilled),
+            'updated': now,
+            'allowed': refilled >= 1,
+        }).returning(cls.allowed, cls.tokens)
+        allowed, tokens = db.session.execute(stmt).one()
+        return allowed, tokens
+
+    # buckets untouched for longer than max_age are full again, the same as no bucket
+    @classmethod
+    def prune(cls, now, max_age):
+        db.session.query(cls).filter(cls.updated < now - max_age).delete(synchronize_session=False)
+
+
+# number of requests rejected by the rate limiter, by limit name
+class RateLimitCounter(db.Model):
+    __bind_key__ = 'ratelimit'
+    __tablename__ = 'rate_limit_counters'
+
+    name = db.Column(db.String(100), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def increment(cls, name):
+        stmt = sqlite_insert(cls).values(name=name, count=1)
+        stmt = stmt.on_conflict_do_update(index_elements=[cls.name], set_={'count': cls.count + 1})
+        db.session.execute(stmt)
+
+    @classmethod
+    def return_all(cls):
+        return {'shed': {counter.name: counter.count for counter in cls.query.order_by(cls.name).all()}}
@@ -0,0 +1,103 @@
+import os
+import smtplib
+import threading
+from flask_mail import Message
+from app import app, mail
+from models import MailOutbox
+
+# background sender of the mail outbox: requests only queue the message (MailOutbox.enqueue) and wake the sender,
+# which sends the due messages in batches over one SMTP connection
+
+# errors caused by the message itself (e.g. a refused recipient), the connection is fine for the other messages
+_MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+def send_batch(limit):
+    """
+    Claim up to limit due messages and send them over one SMTP connection.
+
+    :return: The number of claimed messages (0 when nothing is due).
+    """
+    rows = MailOutbox.claim_due(limit)
+    if not rows:
+        return 0
+
+    sent_ids = []
+    failed_ids = set()
+    error = None
+    try:
+        with mail.connect() as conn:
+            for row in rows:
+                try:
+                    conn.send(Message(subject=row.subject, recipients=[row.recipient], html=row.html))
+                except _MESSAGE_ERRORS as e:
+                    # only this message is retried later
+                    MailOutbox.mark_failed([row], str(e))
+                    failed_ids.add(row.id)
+                    continue
+                sent_ids.append(row.id)
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+    MailOutbox.mark_sent(sent_ids)
+
+    if error:
+        # the connection failed, every message that was not sent is retried with a backoff
+        done = failed_ids.union(sent_ids)
+        MailOutbox.mark_failed([row for row in rows if row.id not in done], error)
+    return len(rows)
+
+def send_due(limit=None):
+    # send until nothing is due, returns the number of processed messages
+    limit = limit or app.config['MAIL_OUTBOX_BATCH_SIZE']
+    total = 0
+    while True:
+        count = send_batch(limit)
+        total += count
+        if count < limit:
+            return total
+
+class OutboxSender:
+    """
+    Daemon thread of one worker process that sends the outbox, woken by new messages and polling for retries.
+    (gunicorn forks the workers, so the thread is started on the first request of every worker, not at import)
+    """
+
+    def __init__(self):
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        if not app.config['MAIL_OUTBOX_WORKER']:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='mail-outbox', daemon=True).start()
+
+    def wake(self):
+        self.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(app.config['MAIL_OUTBOX_POLL_INTERVAL'])
+            self._wakeup.clear()
+            try:
+                with app.app_context():
+                    send_due()
+            except Exception as e:
+                print(e)
+
+sender = OutboxSender()
+
+def queue_mail(recipient, subject, html, dedup_key=None):
+    """
+    Queue an email for the background sender, the caller does not wait for SMTP.
+
+    :return: False if the message was dropped as a duplicate of a recent one (see MailOutbox.enqueue).
+    """
+    queued = MailOutbox.enqueue(recipient, subject, html, dedup_key=dedup_key)
+    if queued:
+        sender.wake()
+    return queued
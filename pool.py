@@ -0,0 +1,43 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# process pool of the CPU-bound work that would hold the request worker's GIL (password hashing, image variants)
+
+class ProcessPool:
+    """
+    A ProcessPoolExecutor created on first use, so every gunicorn worker gets its own pool after the fork.
+    (the functions run in the pool processes have to be importable without the flask app)
+    hashing.py and thumbnails.py each have their own pool, so rendering image variants cannot hold up the logins.
+    """
+
+    def __init__(self, workers=0):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def run(self, fn, *args, timeout=None):
+        """
+        Run a function in the pool and wait for its result.
+
+        :param fn: A module level function.
+        :param timeout: Seconds to wait for the result, None to wait until it is done.
+        :return: The result of fn(*args).
+        :raises concurrent.futures.TimeoutError: If the result is not ready after timeout seconds.
+        """
+        # without workers (e.g. debugging) fn runs on the calling thread
+        if not self.workers:
+            return fn(*args)
+        try:
+            return self._get_executor().submit(fn, *args).result(timeout=timeout)
+        except BrokenProcessPool:
+            # a pool process died, start a new pool for the next calls
+            with self._lock:
+                self._executor = None
+            raise
@@ -0,0 +1,69 @@
+import math
+import random
+import time
+from functools import wraps
+from flask import request
+from werkzeug.exceptions import TooManyRequests
+from app import app, db
+from models import RateLimitBucket, RateLimitCounter
+
+# token bucket rate limiting of the expensive auth endpoints (pbkdf2 hashing, emails), by client ip and by email
+# the buckets are rows of the 'ratelimit' database, so the limits hold across the gunicorn workers
+
+class RateLimited(TooManyRequests):
+    description = 'Too many requests, please try again later'
+
+def _limits():
+    # (kind, capacity, period in seconds), a bucket holds capacity tokens and refills them over period
+    return (
+        ('ip', app.config['RATELIMIT_IP_LIMIT'], app.config['RATELIMIT_IP_PERIOD']),
+        ('email', app.config['RATELIMIT_EMAIL_LIMIT'], app.config['RATELIMIT_EMAIL_PERIOD']),
+    )
+
+def _request_email():
+    # read without the reqparse parser of the endpoint, before it does any work
+    data = request.get_json(silent=True) or {}
+    email = data.get('email') if isinstance(data, dict) else None
+    email = email or request.form.get('email')
+    return email.strip().lower() if isinstance(email, str) and email.strip() else None
+
+def check(name):
+    """
+    Take a token from the ip and the email bucket of the current request.
+
+    :param name: The name of the limited action (e.g. 'signin'), buckets and counters are per action.
+    :raises RateLimited: (429 with Retry-After) if a bucket is empty.
+    """
+    now = time.time()
+    values = {'ip': request.remote_addr or 'unknown', 'email': _request_email()}
+    try:
+        for kind, capacity, period in _limits():
+            if not values[kind] or capacity <= 0:
+                continue
+            rate = capacity / period
+            allowed, tokens = RateLimitBucket.take(f'{name}:{kind}:{values[kind]}', capacity, rate, now)
+            if not allowed:
+                RateLimitCounter.increment(f'{name}:{kind}')
+                db.session.commit()
+                raise RateLimited(retry_after=math.ceil((1 - tokens) / rate))
+        # full buckets carry no state, drop them once in a while
+        if random.random() < 0.01:
+            RateLimitBucket.prune(now, max(period for _, _, period in _limits()))
+        db.session.commit()
+    except RateLimited:
+        raise
+    except Exception as e:
+        # the limiter must not take the endpoint down, let the request through
+        db.session.rollback()
+        print(e)
+
+def rate_limited(name):
+    # decorator for resource methods, checked before the method parses or looks up anything
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if app.config['RATELIMIT_ENABLED']:
+                check(name)
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,8 +1,14 @@
-import datetime
-from models import User, Blog, Comment
-from flask_restful import Resource, reqparse
+import json
+import zlib
+from app import app, db
+from flask import request, make_response, Response, stream_with_context
+from sqlalchemy.orm.exc import StaleDataError
+from cache import TTLCache
+from conditional import make_etag, not_modified, validators
+from models import Blog, Comment, CacheGeneration, CONTENT_ZLIB, decompress_content, format_timestamp, now_timestamp, to_datetime
+from flask_restful import Resource, reqparse, inputs
 # Access token we need to access protected routes. Refresh token we need to reissue access token when it will expire.
-from flask_jwt_extended import (jwt_required, get_jwt_identity)
+from flask_jwt_extended import (jwt_required, get_jwt_identity, current_user)
 
 # add parsing of incoming data inside the POST request
 # required fields are marked as required=True
@@ -14,11 +20,50 @@ parser_create.add_argument('author_email', type=str, required=True, help='Author
 parser_create.add_argument('content', type=str, required=True, help='Content is required')
 parser_create.add_argument('cover_image', type=str, default='')
 
+# partial update, only the fields present in the request are changed
+parser_patch = reqparse.RequestParser()
+parser_patch.add_argument('author_email', type=str, required=True, help='Author_email is required')
+parser_patch.add_argument('version', type=int, required=True, help='Version is required')
+parser_patch.add_argument('category', type=str, nullable=False, store_missing=False)
+parser_patch.add_argument('title', type=str, nullable=False, store_missing=False)
+parser_patch.add_argument('description', type=str, nullable=False, store_missing=False)
+parser_patch.add_argument('cover_image', type=str, nullable=False, store_missing=False)
+parser_patch.add_argument('content', type=str, nullable=False, store_missing=False)
+parser_patch.add_argument('content_sha256', type=str, store_missing=False)
+
 parser_all = reqparse.RequestParser()
 parser_all.add_argument('page', type=int, default=1)
 parser_all.add_argument('per_page', type=int, default=5)
 parser_all.add_argument('last_blog_id', type=int, default=0)
 parser_all.add_argument('last_blog_updated_time', type=str, default=None)
+# keyset mode: send cursor='' for the first page, then the next_cursor of the previous page
+parser_all.add_argument('cursor', type=str, default=None)
+parser_all.add_argument('include_total', type=inputs.boolean, default=False)
+
+# the same arguments read from the query string, for the GET feed (conditional requests)
+parser_all_query = parser_all.copy()
+for arg in parser_all_query.args:
+    arg.location = 'args'
+
+# comment lists are paginated when limit (or cursor) is given, otherwise all comments are returned
+parser_comments = reqparse.RequestParser()
+parser_comments.add_argument('limit', type=int, default=None, location='args')
+parser_comments.add_argument('cursor', type=str, default=None, location='args')
+parser_comments.add_argument('max_depth', type=int, default=None, location='args')
+
+parser_comment_tree = reqparse.RequestParser()
+parser_comment_tree.add_argument('max_depth', type=int, default=None, location='args')
+
+parser_search = reqparse.RequestParser()
+parser_search.add_argument('q', type=str, required=True, location='args', help='Search query is required')
+parser_search.add_argument('page', type=int, default=1, location='args')
+parser_search.add_argument('per_page', type=int, default=10, location='args')
+
+parser_export = reqparse.RequestParser()
+parser_export.add_argument('format', type=str, default='json', choices=('json', 'ndjson'), location='args')
+
+# feed pages encoded as json, keyed by the cache generation and the query parameters (a hit is sent as it is)
+feed_cache = TTLCache(maxsize=app.config['FEED_CACHE_SIZE'], ttl=app.config['FEED_CACHE_TTL'])
 
 parser_comment_create = reqparse.RequestParser()
 parser_comment_create.add_argument('name', type=str, required=True, help='Name is required')
@@ -34,15 +79,14 @@ class BlogCreate(Resource):
         if get_jwt_identity() != data['author_email']:
             return {'message': 'You are not authorized'}, 401
 
-        author_obj = User.find_by_email(data['author_email'])
         # create a new blog object with the data from the request
         new_blog = Blog(
             category=data['category'],
             title=data['title'],
             description=data['description'],
-            created=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            updated=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            author=author_obj,
+            created=now_timestamp(),
+            updated=now_timestamp(),
+            author_id=current_user.id,
             content=data['content'],
             cover_image=data['cover_image']
         )
@@ -71,7 +115,7 @@ class BlogUpdate(Resource):
             blog_obj.category = data['category']
             blog_obj.title = data['title']
             blog_obj.description = data['description']
-            blog_obj.updated = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            blog_obj.updated = now_timestamp()
             blog_obj.content = data['content']
             blog_obj.cover_image = data['cover_image']
 
@@ -84,23 +128,161 @@ class BlogUpdate(Resource):
                 return {'message': 'Something went wrong'}, 500
         else:
             return {'message': 'Blog not found'}, 404
+
+    # autosave from the editor: only the changed fields, and the content as a patch (content_patch) against the given version
+    @jwt_required()
+    def patch(self, id):
+        body = request.get_json(silent=True)
+        if body is not None and not isinstance(body, dict):
+            return {'message': 'Request body must be a JSON object'}, 400
+        data = parser_patch.parse_args()
+        content_patch = (body or {}).get('content_patch')
+
+        if get_jwt_identity() != data['author_email']:
+            return {'message': 'You are not authorized'}, 401
+
+        blog_obj = Blog.find_by_id(id)
+        if not blog_obj:
+            return {'message': 'Blog not found'}, 404
+        if blog_obj.author_id != current_user.id:
+            return {'message': 'You are not authorized'}, 401
+        if blog_obj.version != data['version']:
+            return {'message': 'Blog has been modified, please reload it', 'version': blog_obj.version}, 409
+
+        changes = {field: data[field] for field in ('category', 'title', 'description', 'cover_image', 'content') if field in data}
+        try:
+            changed = blog_obj.apply_changes(changes, content_patch, data.get('content_sha256'))
+        except (ValueError, TypeError) as e:
+            return {'message': str(e)}, 400
+        if not changed:
+            return {'message': 'Nothing changed', 'version': blog_obj.version}
+
+        try:
+            blog_obj.save_to_db()
+            return {
+                'message': 'Blog {} updated successfully'.format(blog_obj.title),
+                'version': blog_obj.version,
+                'updated': format_timestamp(blog_obj.updated),
+            }
+        except StaleDataError:
+            # changed by another request after it was loaded
+            db.session.rollback()
+            return {'message': 'Blog has been modified, please reload it', 'version': Blog.find_version(id).version}, 409
+        except:
+            db.session.rollback()
+            return {'message': 'Something went wrong'}, 500
     
+def _get_feed(data, generation):
+    """
+    Get the feed page for the parsed feed arguments, from the feed cache when possible.
+
+    :param data: The parsed arguments of parser_all.
+    :param generation: The current 'blogs' cache generation.
+    :return: The json response body of the feed page.
+    :raises ValueError: If the cursor or last_blog_updated_time is malformed.
+    """
+    # the generation changes whenever a blog is created, updated or deleted, so stale pages are never hit
+    key = (generation,) + tuple(sorted(data.items()))
+    body = feed_cache.get(key)
+    if body is None:
+        if data['cursor'] is not None:
+            feed = Blog.get_blogs_by_cursor(per_page=data['per_page'], cursor=data['cursor'], include_total=data['include_total'])
+        else:
+            feed = Blog.get_paginated_blogs(page=data['page'], per_page=data['per_page'], last_blog_id=data['last_blog_id'], last_blog_updated_time=data['last_blog_updated_time'])
+        # encoded like the other flask-restful responses
+        body = (json.dumps(feed, **app.config.get('RESTFUL_JSON', {})) + '\n').encode('utf-8')
+        feed_cache.set(key, body)
+    return body
+
 class AllBlogs(Resource):
+    # same as post, but with the arguments in the query string and support for conditional requests (304)
+    def get(self):
+        data = parser_all_query.parse_args()
+        generation = CacheGeneration.current('blogs')
+        etag = make_etag('blogs', generation, sorted(data.items()))
+        response = not_modified(etag)
+        if response:
+            return response
+        try:
+            return Response(_get_feed(data, generation), mimetype='application/json', headers=validators(etag))
+        except ValueError as e:
+            return {'message': str(e)}, 400
+
     def post(self):
         data = parser_all.parse_args()
-        return Blog.get_paginated_blogs(page=data['page'], per_page=data['per_page'], last_blog_id=data['last_blog_id'], last_blog_updated_time=data['last_blog_updated_time'])
+        try:
+            return Response(_get_feed(data, CacheGeneration.current('blogs')), mimetype='application/json')
+        except ValueError as e:
+            return {'message': str(e)}, 400
+    
+# the previews of every blog in id order, streamed (format=ndjson for one blog per line)
+class BlogExport(Resource):
+    def get(self):
+        data = parser_export.parse_args()
+        if data['format'] == 'ndjson':
+            return Response(stream_with_context(Blog.iter_all(ndjson=True)), mimetype='application/x-ndjson')
+        return Response(stream_with_context(Blog.iter_all()), mimetype='application/json')
+
+class BlogSearch(Resource):
+    def get(self):
+        data = parser_search.parse_args()
+        if not data['q'].strip():
+            return {'message': 'Search query is required'}, 400
+        return Blog.search_blogs(data['q'], page=data['page'], per_page=data['per_page'])
     
 class BlogWithId(Resource):
     def get(self, id):
-        return Blog.find_by_id(id, requireJson=True)
+        # decide on the validators first, the content is only loaded when the client copy is stale
+        version = Blog.find_version(id)
+        if not version:
+            return {'message': 'Blog not found'}, 404
+        etag = make_etag('blog', version.id, version.version, version.updated)
+        last_modified = to_datetime(version.updated)
+        response = not_modified(etag, last_modified)
+        if response:
+            return response
+        return Blog.find_by_id(id, requireJson=True), 200, validators(etag, last_modified)
 
     @jwt_required()
     def delete(self, id):
-        email = Blog.find_by_id(id).author.email
-        if email != get_jwt_identity():
+        author_id = Blog.find_author_id(id)
+        if author_id is None:
+            return {'message': 'Blog not found'}, 404
+        if author_id != current_user.id:
             return {'message': 'You are not authorized'}, 401
         return Blog.delete_by_id(id)
     
+# the html content only, compressed contents are sent as they are stored to clients accepting 'deflate'
+class BlogContent(Resource):
+    def get(self, id):
+        version = Blog.find_version(id)
+        if not version:
+            return {'message': 'Blog not found'}, 404
+        # the encoding only depends on the request, every ETag stands for one byte sequence (strong validator)
+        encoding = 'deflate' if request.accept_encodings['deflate'] else 'identity'
+        etag = make_etag('blog-content', version.id, version.version, version.updated, encoding)
+        last_modified = to_datetime(version.updated)
+        response = not_modified(etag, last_modified)
+        if response:
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
+
+        stored = Blog.find_stored_content(id)
+        if encoding == 'deflate':
+            if isinstance(stored, bytes) and stored[:1] == CONTENT_ZLIB:
+                body = stored[1:]
+            else:
+                # small and not yet converted contents are stored uncompressed
+                body = zlib.compress(decompress_content(stored).encode('utf-8'), 6)
+            response = make_response(body)
+            response.headers['Content-Encoding'] = 'deflate'
+        else:
+            response = make_response(decompress_content(stored).encode('utf-8'))
+        response.headers['Content-Type'] = 'text/html; charset=utf-8'
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers.update(validators(etag, last_modified))
+        return response
+    
 class CommentPost(Resource):
     def post(self, id):
         data = parser_comment_create.parse_args()
@@ -119,7 +301,7 @@ class CommentPost(Resource):
             name=data['name'],
             email=data['email'],
             content=data['content'],
-            created=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            created=now_timestamp(),
         )
 
         # save the new comment object to the database
@@ -131,6 +313,29 @@ class CommentPost(Resource):
         except:
             return {'message': 'Something went wrong'}, 500
         
+# import whole comment threads (e.g. from another blog platform), only the author of the blog can do it
+class CommentImport(Resource):
+    @jwt_required()
+    def post(self, id):
+        blog_obj = Blog.find_by_id(id)
+        if not blog_obj:
+            return {'message': 'Blog not found'}, 404
+        if blog_obj.author_id != current_user.id:
+            return {'message': 'You are not authorized'}, 401
+
+        threads = (request.get_json(silent=True) or {}).get('comments')
+        try:
+            num_comments = Comment.bulk_insert(id, threads)
+            return {
+                'message': f'{num_comments} comment(s) imported',
+            }
+        except ValueError as e:
+            db.session.rollback()
+            return {'message': str(e)}, 400
+        except:
+            db.session.rollback()
+            return {'message': 'Something went wrong'}, 500
+        
 class CommentWithId(Resource):
     def delete(self, id, commentId):
         comment_obj = Comment.find_by_id(commentId)
@@ -146,13 +351,45 @@ class CommentWithId(Resource):
 
 class AllComments(Resource):
     def get(self, id):
-        return Blog.get_comments(id)
+        data = parser_comments.parse_args()
+        etag = make_etag('comments', id, CacheGeneration.current(f'comments:{id}'), sorted(data.items()))
+        response = not_modified(etag)
+        if response:
+            return response
+        if data['limit'] is None and data['cursor'] is None:
+            return Blog.get_comments(id), 200, validators(etag)
+        try:
+            return Blog.get_comments_page(id, limit=data['limit'] or 20, cursor=data['cursor']), 200, validators(etag)
+        except ValueError as e:
+            return {'message': str(e)}, 400
+    
+# the whole nested comment tree of a blog (or its first max_depth levels) in one streamed response
+class CommentTree(Resource):
+    def get(self, id):
+        data = parser_comment_tree.parse_args()
+        etag = make_etag('comment-tree', id, CacheGeneration.current(f'comments:{id}'), data['max_depth'])
+        response = not_modified(etag)
+        if response:
+            return response
+        response = Response(stream_with_context(Blog.iter_comment_tree(id, max_depth=data['max_depth'])), mimetype='application/json')
+        response.headers.update(validators(etag))
+        return response
     
 class CommentReplies(Resource):
     def get(self, id, commentId):
+        data = parser_comments.parse_args()
+        etag = make_etag('replies', id, commentId, CacheGeneration.current(f'comments:{id}'), sorted(data.items()))
+        response = not_modified(etag)
+        if response:
+            return response
         comment = Comment.find_by_id(commentId)
         if comment:
             commentPath = comment.path
-            return Blog.get_comment_replies(id, commentPath)
+            if data['limit'] is None and data['cursor'] is None:
+                return Blog.get_comment_replies(id, commentPath), 200, validators(etag)
+            try:
+                return Blog.get_comment_replies_page(id, commentPath, limit=data['limit'] or 20, cursor=data['cursor'], max_depth=data['max_depth']), 200, validators(etag)
+            except ValueError as e:
+                return {'message': str(e)}, 400
         else:
             return {'message': 'Comment not found'}, 404
\ No newline at end of file
@@ -1,38 +1,171 @@
 import datetime
-from models import Image, Blog, User
-from flask_restful import Resource, reqparse
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from models import Image, Blog
+from flask import Response, stream_with_context
+from flask_restful import Resource, inputs, reqparse
 from werkzeug.datastructures import FileStorage
 # Access token we need to access protected routes. Refresh token we need to reissue access token when it will expire.
-from flask_jwt_extended import (create_access_token, create_refresh_token, jwt_required, get_jwt_identity, get_jwt)
-
-# for uploading images to COS bucket
-from qcloud_cos import CosConfig
-from qcloud_cos import CosS3Client
-import sys
-import os
-import logging
-
-# 正常情况日志级别使用 INFO，需要定位时可以修改为 DEBUG，此时 SDK 会打印和服务端的通信信息
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-
-# 1. 设置用户属性, 包括 secret_id, secret_key, region等。Appid 已在 CosConfig 中移除，请在参数 Bucket 中带上 Appid。Bucket 由 BucketName-Appid 组成
-secret_id = os.environ['COS_SECRET_ID']     # 用户的 SecretId，建议使用子账号密钥，授权遵循最小权限指引，降低使用风险。子账号密钥获取可参见 https://cloud.tencent.com/document/product/598/37140
-secret_key = os.environ['COS_SECRET_KEY']   # 用户的 SecretKey，建议使用子账号密钥，授权遵循最小权限指引，降低使用风险。子账号密钥获取可参见 https://cloud.tencent.com/document/product/598/37140
-region = 'ap-nanjing'      # 替换为用户的 region，已创建桶归属的 region 可以在控制台查看，https://console.cloud.tencent.com/cos5/bucket
-                           # COS 支持的所有 region 列表参见 https://cloud.tencent.com/document/product/436/6224
-token = None               # 如果使用永久密钥不需要填入 token，如果使用临时密钥需要填入，临时密钥生成和使用指引参见 https://cloud.tencent.com/document/product/436/14048
-scheme = 'https'           # 指定使用 http/https 协议来访问 COS，默认为 https，可不填
+from flask_jwt_extended import (create_access_token, create_refresh_token, jwt_required, get_jwt_identity, get_jwt, current_user)
 
-
-config = CosConfig(Region=region, SecretId=secret_id, SecretKey=secret_key, Token=token, Scheme=scheme)
-client = CosS3Client(config)
-bucket = 'bounden-1312559530'
+# the uploaded files go to the storage backend of storage.py (COS bucket or local files)
+from app import app, storage, thumbnailer
+from storage import content_hash as upload_hash
+from thumbnails import FORMATS, srcset
 
 parser_upload = reqparse.RequestParser()
 parser_upload.add_argument('user_email', type=str, help = 'This field cannot be blank', required = True, location = 'form')
 parser_upload.add_argument('name', type=str, help = 'This field cannot be blank', required = True, location = 'form')
 parser_upload.add_argument('file', type=FileStorage, help = 'This field cannot be blank', required = True, location = 'files')
 
+parser_batch = reqparse.RequestParser()
+parser_batch.add_argument('user_email', type=str, help = 'This field cannot be blank', required = True, location = 'form')
+parser_batch.add_argument('files', type=FileStorage, help = 'This field cannot be blank', required = True, location = 'files', action = 'append')
+
+# direct uploads: presign returns a short-lived url the client PUTs the file to, confirm then records the image
+parser_presign = reqparse.RequestParser()
+parser_presign.add_argument('user_email', type=str, help = 'This field cannot be blank', required = True)
+parser_presign.add_argument('name', type=str, help = 'This field cannot be blank', required = True)
+
+parser_confirm = parser_presign.copy()
+parser_confirm.add_argument('key', type=str, help = 'This field cannot be blank', required = True)
+
+# image listing: paginated when limit (or cursor) is given, otherwise every image is streamed (format=ndjson for one image per line)
+parser_images = reqparse.RequestParser()
+parser_images.add_argument('limit', type=int, default=None, location='args')
+parser_images.add_argument('cursor', type=str, default=None, location='args')
+parser_images.add_argument('format', type=str, default='json', choices=('json', 'ndjson'), location='args')
+
+parser_user_images = reqparse.RequestParser()
+parser_user_images.add_argument('limit', type=int, default=20, location='args')
+parser_user_images.add_argument('cursor', type=str, default=None, location='args')
+parser_user_images.add_argument('variants', type=inputs.boolean, default=False, location='args')
+
+def variant_key(content_hash, width, name):
+    return f'image-variants/{content_hash}/{width}.{name}'
+
+def put_variants(content_hash, stream):
+    """
+    Render and store the resized variants of an image (no database or request context, safe in the batch threads).
+
+    :param content_hash: The sha256 of the image.
+    :param stream: The image file (read from the start).
+    :return: A list of (width, format name, storage key), None if the image cannot be rendered.
+    """
+    try:
+        stream.seek(0)
+        # the pool process reads the image from a file, the worker only copies it in chunks (the spooled upload has no path)
+        with tempfile.NamedTemporaryFile(prefix='variants-') as original:
+            shutil.copyfileobj(stream, original, 1024 * 1024)
+            original.flush()
+            rendered = thumbnailer.render(original.name)
+        keys = []
+        for width, name, body in rendered:
+            key = variant_key(content_hash, width, name)
+            storage.put(key, io.BytesIO(body), len(body), content_type=FORMATS[name][1])
+            keys.append((width, name, key))
+        return keys
+    except Exception as e:
+        # not an image Pillow can read, or the pool is broken: the original is still usable
+        print(e)
+        return None
+    finally:
+        stream.seek(0)
+
+def variant_urls(variant_keys):
+    # {'webp': {'<width>': url, ...}, 'jpeg': {...}}
+    if variant_keys is None:
+        return None
+    variants = {}
+    for width, name, key in variant_keys:
+        variants.setdefault(name, {})[str(width)] = storage.url(key)
+    return variants
+
+def file_size(stream):
+    # the form parser has spooled the file to disk (above 500 KB), measure it without reading it
+    stream.seek(0, 2)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+# the extension of an uploaded file name, only letters and digits (the rest of the client name is never used in keys)
+def file_extension(filename):
+    extension = os.path.splitext(filename or '')[1].lower()
+    return extension if re.fullmatch(r'\.[a-z0-9]{1,10}', extension) else ''
+
+def content_key(content_hash, filename):
+    return 'blog-images/' + content_hash + file_extension(filename)
+
+# presigned uploads get a random key in the user's folder, an upload never replaces another one
+def presigned_key(user_email, filename):
+    return f"blog-images/{user_email}/{datetime.datetime.now().strftime('%Y%m%d')}_{uuid.uuid4().hex}{file_extension(filename)}"
+
+def is_presigned_key(key, user_email):
+    return re.fullmatch(re.escape(f'blog-images/{user_email}/') + r'\d{8}_[0-9a-f]{32}(\.[a-z0-9]{1,10})?', key) is not None
+
+def write_content(file, content_hash, size, stored_key=None, render=True):
+    """
+    Store an uploaded file under its content hash and render its variants (no database or request context, safe in the batch threads).
+
+    :param file: The uploaded FileStorage.
+    :param content_hash: The sha256 of the file.
+    :param size: The size of the file in bytes.
+    :param stored_key: The key of the content if an image already has it, nothing is uploaded then.
+    :param render: Render the variants (False if the content already has them).
+    :return: A tuple (storage key, variant keys).
+    """
+    key = stored_key
+    if key is None:
+        key = content_key(content_hash, file.filename)
+        # the object may exist without an image row (e.g. the row was not saved)
+        if storage.size(key) is None:
+            storage.put(key, file.stream, size, content_type=file.mimetype)
+    # post-upload stage: resized variants for srcset (rendered in the thumbnail process pool)
+    variant_keys = put_variants(content_hash, file.stream) if render else None
+    return key, variant_keys
+
+def store_file(file, content_hash, size):
+    """
+    Store an uploaded file under its content hash, the upload is skipped if the content is already stored.
+
+    :param file: The uploaded FileStorage.
+    :param content_hash: The sha256 of the file.
+    :param size: The size of the file in bytes.
+    :return: A tuple (storage key, url, variants).
+    """
+    shared = Image.find_by_content(content_hash)
+    known_variants = Image.find_variants(content_hash)
+    key, variant_keys = write_content(file, content_hash, size, stored_key=shared.storage_key if shared else None, render=not known_variants)
+    return key, storage.url(key), known_variants or variant_urls(variant_keys)
+
+# threads of the batch uploads (storage writes are network bound), created on first use in every worker
+_upload_pool = None
+_upload_pool_lock = threading.Lock()
+
+def upload_pool():
+    global _upload_pool
+    with _upload_pool_lock:
+        if _upload_pool is None:
+            _upload_pool = ThreadPoolExecutor(max_workers=app.config['IMAGE_BATCH_THREADS'], thread_name_prefix='image-upload')
+        return _upload_pool
+
+def image_urls(image):
+    return {
+        'id': image.id,
+        'url': image.image_url,
+        'variants': image.variants,
+        'srcset': srcset(image.variants),
+    }
+
+def upload_to_json(image):
+    return {'message': 'Image uploaded successfully', **image_urls(image)}
+
 class ImageUpload(Resource):
     @jwt_required()
     def post(self):
@@ -41,36 +174,235 @@ class ImageUpload(Resource):
         if get_jwt_identity() != data['user_email']:
             return {'message': 'You are not authorized'}, 401
         
-        response = client.put_object(
-            Bucket=bucket,
-            Body=data.file.stream.read(),
-            Key='blog-images/' + data.user_email + '/' + datetime.datetime.now().strftime('%Y%m%d_') + data.name,
-            StorageClass='STANDARD',
-            EnableMD5=False
-        )
-        if response['ETag'] != None:
-            author_obj = User.find_by_email(data.user_email)
-            if not author_obj:
-                return {
-                    'message': 'Author not found'
-                }
-            
-            new_image = Image(
-                name = data.name,
-                user = author_obj,
-                image_url = 'https://' + bucket + '.cos.' + region + '.myqcloud.com/blog-images/' + data.user_email + '/' + datetime.datetime.now().strftime('%Y%m%d_') + data.name,
-            )
-            # save the new blog object to the database
+        size = file_size(data.file.stream)
+        if size > app.config['IMAGE_MAX_SIZE']:
+            return {'message': 'Image is too large'}, 413
+        # computed while the file was received (HashingRequest)
+        content_hash = upload_hash(data.file.stream)
+
+        # the same picture uploaded again by the user is one image with another reference
+        existing = Image.find_by_content(content_hash, user_id=current_user.id)
+        if existing:
             try:
-                new_image.save_to_db()
-                return {
-                    'message': 'Image uploaded successfully',
-                    'url': 'https://' + bucket + '.cos.' + region + '.myqcloud.com/blog-images/' + data.user_email + '/' + datetime.datetime.now().strftime('%Y%m%d_') + data.name,
-                }
+                Image.add_reference(existing.id)
+                return upload_to_json(existing)
             except:
                 return {'message': 'Something went wrong'}, 500
-        else:
+
+        try:
+            key, image_url, variants = store_file(data.file, content_hash, size)
+        except Exception as e:
+            print(e)
             return {
                 'message': 'Image upload failed'
-            }
-        
\ No newline at end of file
+            }, 500
+
+        new_image = Image(
+            name = data.name,
+            user_id = current_user.id,
+            image_url = image_url,
+            content_hash = content_hash,
+            storage_key = key,
+            variants = variants,
+        )
+        # save the new blog object to the database
+        try:
+            new_image.save_to_db()
+            return upload_to_json(new_image)
+        except:
+            return {'message': 'Something went wrong'}, 500
+
+# several images in one multipart request (field 'files'), stored concurrently and recorded in one transaction
+# the result of every file is returned, a failed file does not fail the others
+class ImageBatchUpload(Resource):
+    max_content_length = app.config['IMAGE_BATCH_MAX_SIZE']
+
+    @jwt_required()
+    def post(self):
+        data = parser_batch.parse_args()
+
+        if get_jwt_identity() != data['user_email']:
+            return {'message': 'You are not authorized'}, 401
+        files = data['files']
+        if len(files) > app.config['IMAGE_BATCH_MAX_FILES']:
+            return {'message': 'Too many files, at most {} per request'.format(app.config['IMAGE_BATCH_MAX_FILES'])}, 400
+
+        results = [None] * len(files)
+        # indexes of the files that are new references to the user's existing images, by image id
+        references = {}
+        # one upload per new content, files with the same content in the batch share it: {content_hash: upload}
+        uploads = {}
+        for index, file in enumerate(files):
+            size = file_size(file.stream)
+            if size > app.config['IMAGE_MAX_SIZE']:
+                results[index] = {'name': file.filename, 'status': 'failed', 'message': 'Image is too large'}
+                continue
+            content_hash = upload_hash(file.stream)
+            existing = Image.find_by_content(content_hash, user_id=current_user.id)
+            if existing:
+                references.setdefault(existing.id, []).append(index)
+            elif content_hash in uploads:
+                uploads[content_hash]['indexes'].append(index)
+            else:
+                # the database lookups stay on this thread, the pool only talks to the storage
+                shared = Image.find_by_content(content_hash)
+                known_variants = Image.find_variants(content_hash)
+                future = upload_pool().submit(write_content, file, content_hash, size, shared.storage_key if shared else None, not known_variants)
+                uploads[content_hash] = {'file': file, 'indexes': [index], 'known_variants': known_variants, 'future': future}
+
+        new_images = []
+        for content_hash, upload in uploads.items():
+            try:
+                key, variant_keys = upload['future'].result()
+            except Exception as e:
+                print(e)
+                for index in upload['indexes']:
+                    results[index] = {'name': files[index].filename, 'status': 'failed', 'message': 'Image upload failed'}
+                continue
+            upload['image'] = Image(
+                name = upload['file'].filename,
+                user_id = current_user.id,
+                image_url = storage.url(key),
+                content_hash = content_hash,
+                storage_key = key,
+                variants = upload['known_variants'] or variant_urls(variant_keys),
+                ref_count = len(upload['indexes']),
+            )
+            new_images.append(upload['image'])
+
+        try:
+            Image.save_batch(new_images, {id: len(indexes) for id, indexes in references.items()})
+        except:
+            return {'message': 'Something went wrong'}, 500
+
+        for upload in uploads.values():
+            if 'image' in upload:
+                for index in upload['indexes']:
+                    results[index] = {'name': files[index].filename, 'status': 'uploaded', **image_urls(upload['image'])}
+        for id, indexes in references.items():
+            image = Image.find_by_id(id)
+            for index in indexes:
+                results[index] = {'name': files[index].filename, 'status': 'uploaded', **image_urls(image)}
+
+        uploaded = sum(1 for result in results if result['status'] == 'uploaded')
+        return {
+            'message': '{} of {} image(s) uploaded'.format(uploaded, len(files)),
+            'results': results,
+        }
+
+# drop the user's reference to an image, the stored file and its variants are deleted when no image uses them anymore
+class ImageWithId(Resource):
+    @jwt_required()
+    def delete(self, id):
+        image = Image.find_by_id(id)
+        if not image:
+            return {'message': 'Image not found'}, 404
+        if image.user_id != current_user.id:
+            return {'message': 'You are not authorized'}, 401
+
+        # read before the release, the row may be deleted
+        storage_key, content_hash, variants, ref_count = image.storage_key, image.content_hash, image.variants, image.ref_count
+        try:
+            unused = Image.release(image)
+        except:
+            return {'message': 'Something went wrong'}, 500
+        if unused and storage_key:
+            try:
+                storage.delete(storage_key)
+                for name, urls in (variants or {}).items():
+                    for width in urls:
+                        storage.delete(variant_key(content_hash, width, name))
+            except Exception as e:
+                # the image is already released, a left over file is only wasted space
+                print(e)
+        return {
+            'message': 'Image deleted' if ref_count <= 1 else 'Image reference released',
+            'references': max(ref_count - 1, 0),
+        }
+
+class ImagePresign(Resource):
+    @jwt_required()
+    def post(self):
+        data = parser_presign.parse_args()
+
+        if get_jwt_identity() != data['user_email']:
+            return {'message': 'You are not authorized'}, 401
+
+        # the key is chosen here, the signed url only allows uploading to the user's own folder
+        key = presigned_key(data.user_email, data.name)
+        expires = app.config['IMAGE_PRESIGN_EXPIRES']
+        try:
+            upload_url = storage.presign_put(key, expires)
+        except Exception as e:
+            print(e)
+            return {'message': 'Something went wrong'}, 500
+        return {
+            'upload_url': upload_url,
+            'method': 'PUT',
+            'key': key,
+            'expires_in': expires,
+            'max_size': app.config['IMAGE_MAX_SIZE'],
+        }
+
+class ImageConfirm(Resource):
+    @jwt_required()
+    def post(self):
+        data = parser_confirm.parse_args()
+
+        if get_jwt_identity() != data['user_email']:
+            return {'message': 'You are not authorized'}, 401
+        if not is_presigned_key(data.key, data.user_email):
+            return {'message': 'You are not authorized'}, 401
+
+        try:
+            size = storage.size(data.key)
+        except Exception as e:
+            print(e)
+            return {'message': 'Something went wrong'}, 500
+        if size is None:
+            return {'message': 'Image not found, upload it first'}, 404
+        # the presigned url cannot limit the size, check it after the upload
+        if size > app.config['IMAGE_MAX_SIZE']:
+            try:
+                storage.delete(data.key)
+            except Exception as e:
+                # the upload is rejected either way, a left over file is only wasted space
+                print(e)
+            return {'message': 'Image is too large'}, 413
+
+        image_url = storage.url(data.key)
+        try:
+            created = Image.create_for_key(data.name, current_user.id, image_url, data.key)
+        except:
+            return {'message': 'Something went wrong'}, 500
+        if not created:
+            return {'message': 'Image already confirmed'}, 409
+        return {
+            'message': 'Image uploaded successfully',
+            'url': image_url,
+        }
+
+class AllImages(Resource):
+    @jwt_required()
+    def get(self):
+        data = parser_images.parse_args()
+        if data['limit'] is not None or data['cursor'] is not None:
+            try:
+                return Image.get_images_page(limit=data['limit'] or 20, cursor=data['cursor'])
+            except ValueError as e:
+                return {'message': str(e)}, 400
+        if data['format'] == 'ndjson':
+            return Response(stream_with_context(Image.iter_all(ndjson=True)), mimetype='application/x-ndjson')
+        return Response(stream_with_context(Image.iter_all()), mimetype='application/json')
+
+# the image library of a user (e.g. the image picker of the editor), newest first
+class UserImages(Resource):
+    @jwt_required()
+    def get(self, email):
+        if get_jwt_identity() != email:
+            return {'message': 'You are not authorized'}, 401
+        data = parser_user_images.parse_args()
+        try:
+            return Image.get_user_images_page(current_user.id, limit=data['limit'], cursor=data['cursor'], include_variants=data['variants'])
+        except ValueError as e:
+            return {'message': str(e)}, 400
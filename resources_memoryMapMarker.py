@@ -1,7 +1,6 @@
-import datetime
-from models import Image, User, MemoryMapMarker
+from models import Image, MemoryMapMarker, now_timestamp
 from flask_restful import Resource, reqparse
-from flask_jwt_extended import (jwt_required, get_jwt_identity)
+from flask_jwt_extended import (jwt_required, get_jwt_identity, current_user)
 
 parser_create = reqparse.RequestParser()
 parser_create.add_argument('user_email', type=str, required=True, help='User email is required')
@@ -29,17 +28,16 @@ class MemoryMapMarkerCreate(Resource):
         if get_jwt_identity() != data['user_email']:
             return {'message': 'You are not authorized'}, 401
         
-        user_obj = User.find_by_email(data['user_email'])
         # create a new marker
         new_marker = MemoryMapMarker(
-            user=user_obj,
+            user_id=current_user.id,
             name="",
             description="",
             latitude=data['latitude'],
             longitude=data['longitude'],
             images="",
-            created=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            updated=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            created=now_timestamp(),
+            updated=now_timestamp(),
         )
 
         # save the marker to the database
@@ -68,7 +66,7 @@ class MemoryMapMarkerUpdate(Resource):
             marker.latitude = data['latitude']
             marker.longitude = data['longitude']
             marker.images = data['images']
-            marker.updated = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            marker.updated = now_timestamp()
 
             try:
                 marker.save_to_db()
@@ -98,5 +96,4 @@ class MemoryMapMarkerList(Resource):
         if get_jwt_identity() != user_email:
             return {'message': 'You are not authorized'}, 401
         
-        user = User.find_by_email(user_email)
-        return MemoryMapMarker.return_all_with_user_id(user.id)
\ No newline at end of file
+        return MemoryMapMarker.return_all_with_user_id(current_user.id)
\ No newline at end of file
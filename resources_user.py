@@ -1,11 +1,12 @@
-from models import User
-from flask import render_template, make_response
-from flask_restful import Resource, reqparse
+from models import User, Blog, RateLimitCounter
+from flask import render_template, make_response, Response, stream_with_context
+from flask_restful import Resource, reqparse, inputs
 # Access token we need to access protected routes. Refresh token we need to reissue access token when it will expire.
-from flask_jwt_extended import (create_access_token, create_refresh_token, jwt_required, get_jwt_identity, get_jwt)
-from flask_mail import Message
+from flask_jwt_extended import (create_access_token, create_refresh_token, jwt_required, get_jwt_identity, get_jwt, current_user)
 from itsdangerous import SignatureExpired, BadTimeSignature
-from app import mail, serializer, api
+from app import serializer, api, jwt
+from outbox import queue_mail
+from ratelimit import rate_limited
 # for email validation
 import re
 
@@ -30,13 +31,28 @@ parser_reset_password.add_argument('token', type=str, help='Token is required',
 parser_reset_password.add_argument('email', type=str, help='Email is required', required=True, location='form')
 parser_reset_password.add_argument('new_password', type=str, help='New password is required', required=True, location='form')
 
+# user listing: paginated when limit (or cursor) is given, otherwise every user is streamed (format=ndjson for one user per line)
+parser_users = reqparse.RequestParser()
+parser_users.add_argument('limit', type=int, default=None, location='args')
+parser_users.add_argument('cursor', type=str, default=None, location='args')
+parser_users.add_argument('format', type=str, default='json', choices=('json', 'ndjson'), location='args')
+
+# resolve the JWT identity once per request, resources read it as current_user (a UserIdentity, no query when cached)
+@jwt.user_lookup_loader
+def load_current_user(jwt_header, jwt_data):
+    return User.find_identity(jwt_data['sub'])
+
 parser_all_blogs = reqparse.RequestParser()
 parser_all_blogs.add_argument('page', type=int, default=1)
 parser_all_blogs.add_argument('per_page', type=int, default=5)
 parser_all_blogs.add_argument('last_blog_id', type=int, default=0)
 parser_all_blogs.add_argument('last_blog_updated_time', type=str, default=None)
+# keyset mode: send cursor='' for the first page, then the next_cursor of the previous page
+parser_all_blogs.add_argument('cursor', type=str, default=None)
+parser_all_blogs.add_argument('include_total', type=inputs.boolean, default=False)
 
 class UserForgotPassword(Resource):
+    @rate_limited('forgot_password')
     def post(self):
         data = parser_forgot_password.parse_args()
 
@@ -52,9 +68,9 @@ class UserForgotPassword(Resource):
         try:
             reset_token = serializer.dumps(data['email'], salt='forgot-password-salt')
             reset_link = api.url_for(UserResetPasswordRequest, token=reset_token, _external=True)
-            message = Message(subject='Password Reset - 重置密码', recipients=[data['email']])
-            message.html = render_template('password_reset_request.html', reset_link=reset_link)
-            mail.send(message)
+            # queued for the background sender, repeated requests within a short time send one email
+            queue_mail(data['email'], 'Password Reset - 重置密码', render_template('password_reset_request.html', reset_link=reset_link),
+                       dedup_key='reset:' + data['email'].lower())
             return {'message': 'Password reset instructions sent to your email'}, 200
         except Exception as e:
             print(e)
@@ -184,6 +200,7 @@ class UserVerifyEmail(Resource):
             return err_res
 
 class UserSignUp(Resource):
+    @rate_limited('signup')
     def post(self):
         data = parser_signup.parse_args()
         if len(data['username']) < 2:
@@ -207,11 +224,10 @@ class UserSignUp(Resource):
             try:
                 # save user to database
                 user.save_to_db()
-                # send verification email
+                # queue verification email
                 verification_link = api.url_for(UserVerifyEmail, token=token, _external=True)
-                message = Message(subject = 'Email Verification - 邮箱验证链接', recipients=[data['email']])
-                message.html = render_template('email_verification_request.html', verification_link=verification_link)
-                mail.send(message)
+                queue_mail(data['email'], 'Email Verification - 邮箱验证链接', render_template('email_verification_request.html', verification_link=verification_link),
+                           dedup_key='verify:' + data['email'].lower())
                 return {
                     'message': 'Verification email sent',
                     'username': user.username,
@@ -230,11 +246,10 @@ class UserSignUp(Resource):
             try:
                 # save user to database
                 new_user.save_to_db()
-                # send verification email
+                # queue verification email
                 verification_link = api.url_for(UserVerifyEmail, token=token, _external=True)
-                message = Message(subject = 'Email Verification - 邮箱验证链接', recipients=[data['email']])
-                message.html = render_template('email_verification_request.html', verification_link=verification_link)
-                mail.send(message)
+                queue_mail(data['email'], 'Email Verification - 邮箱验证链接', render_template('email_verification_request.html', verification_link=verification_link),
+                           dedup_key='verify:' + data['email'].lower())
                 return {
                     'message': 'Verification email sent',
                     'username': new_user.username,
@@ -245,6 +260,7 @@ class UserSignUp(Resource):
 
 
 class UserSignIn(Resource):
+    @rate_limited('signin')
     def post(self):
         data = parser_signin.parse_args()
 
@@ -259,6 +275,14 @@ class UserSignIn(Resource):
         
         if not current_user.verified:
             return {'message': 'Email is not verified'}
+
+        # upgrade the stored hash when the hashing parameters changed, the login does not fail if this does
+        if User.needs_rehash(current_user.password):
+            try:
+                current_user.password = User.generate_hash(data['password'])
+                current_user.save_to_db()
+            except Exception as e:
+                print(e)
       
         access_token = create_access_token(identity = data['email'])
         refresh_token = create_refresh_token(identity = data['email'])
@@ -281,7 +305,15 @@ class TokenRefresh(Resource):
       
 class AllUsers(Resource):
     def get(self):
-        return User.return_all()
+        data = parser_users.parse_args()
+        if data['limit'] is not None or data['cursor'] is not None:
+            try:
+                return User.get_users_page(limit=data['limit'] or 20, cursor=data['cursor'])
+            except ValueError as e:
+                return {'message': str(e)}, 400
+        if data['format'] == 'ndjson':
+            return Response(stream_with_context(User.iter_all(ndjson=True)), mimetype='application/x-ndjson')
+        return Response(stream_with_context(User.iter_all()), mimetype='application/json')
 
     # comment this when using in production
     def delete(self):
@@ -294,4 +326,15 @@ class UserAllBlogs(Resource):
         if get_jwt_identity() != email:
             return {'message': 'You are not authorized'}, 401
         data = parser_all_blogs.parse_args()
-        return User.find_by_email(email).return_blogs(page=data['page'], per_page=data['per_page'], last_blog_id=data['last_blog_id'], last_blog_updated_time=data['last_blog_updated_time'])
\ No newline at end of file
+        try:
+            if data['cursor'] is not None:
+                return Blog.get_blogs_by_cursor(per_page=data['per_page'], cursor=data['cursor'], include_total=data['include_total'], author_id=current_user.id)
+            return Blog.get_paginated_blogs(page=data['page'], per_page=data['per_page'], last_blog_id=data['last_blog_id'], last_blog_updated_time=data['last_blog_updated_time'], author_id=current_user.id)
+        except ValueError as e:
+            return {'message': str(e)}, 400
+
+# number of requests rejected by the rate limiter since the database was created, by action and bucket kind
+class RateLimitStats(Resource):
+    @jwt_required()
+    def get(self):
+        return RateLimitCounter.return_all()
@@ -0,0 +1,117 @@
+import html
+from html.parser import HTMLParser
+from app import db
+from sqlalchemy import text
+
+# full-text search over blogs with a SQLite FTS5 table (rowid = blogs.id)
+# the trigram tokenizer matches substrings, so Chinese text without word boundaries is searchable too
+
+# block level tags of the Tiptap HTML, a space is inserted at their boundaries so that words do not stick together
+_BLOCK_TAGS = {'p', 'br', 'div', 'li', 'ul', 'ol', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'pre', 'td', 'th', 'tr', 'img', 'hr'}
+
+# markers put around the matched text by snippet(), replaced by <mark> after the snippet is escaped
+_MATCH_START = '\x02'
+_MATCH_END = '\x03'
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _BLOCK_TAGS:
+            self.parts.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag in _BLOCK_TAGS:
+            self.parts.append(' ')
+
+    def handle_data(self, data):
+        self.parts.append(data)
+
+def html_to_text(content):
+    extractor = _TextExtractor()
+    extractor.feed(content or '')
+    extractor.close()
+    return ' '.join(''.join(extractor.parts).split())
+
+def create_index():
+    db.session.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS blogs_fts USING fts5(title, description, body, tokenize='trigram')"))
+    db.session.commit()
+
+# index_blog and remove_blog are part of the current transaction, the index is committed together with the blog
+def index_blog(blog):
+    remove_blog(blog.id)
+    db.session.execute(
+        text('INSERT INTO blogs_fts (rowid, title, description, body) VALUES (:id, :title, :description, :body)'),
+        {'id': blog.id, 'title': blog.title, 'description': blog.description or '', 'body': html_to_text(blog.content)},
+    )
+
+def remove_blog(id):
+    db.session.execute(text('DELETE FROM blogs_fts WHERE rowid = :id'), {'id': id})
+
+def clear_index():
+    db.session.execute(text('DELETE FROM blogs_fts'))
+
+def rebuild_index(rows):
+    """
+    Rebuild the whole search index.
+
+    :param rows: Iterable of (id, title, description, content) of every blog.
+    :return: The number of indexed blogs.
+    """
+    clear_index()
+    count = 0
+    batch = []
+    for id, title, description, content in rows:
+        batch.append({'id': id, 'title': title, 'description': description or '', 'body': html_to_text(content)})
+        if len(batch) >= 500:
+            db.session.execute(text('INSERT INTO blogs_fts (rowid, title, description, body) VALUES (:id, :title, :description, :body)'), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(text('INSERT INTO blogs_fts (rowid, title, description, body) VALUES (:id, :title, :description, :body)'), batch)
+        count += len(batch)
+    # merge the b-trees of the index for faster queries
+    db.session.execute(text("INSERT INTO blogs_fts (blogs_fts) VALUES ('optimize')"))
+    db.session.commit()
+    return count
+
+def match(query, limit, offset):
+    """
+    Search the blogs index, best matches first.
+
+    :param query: The search words of the user (all of them have to match).
+    :param limit: Maximum number of results.
+    :param offset: Number of results to skip.
+    :return: A list of (blog id, html snippet) tuples.
+    """
+    # trigram queries need at least 3 characters, shorter words are matched with LIKE instead
+    words = query.split()
+    phrases = ['"' + word.replace('"', '""') + '"' for word in words if len(word) >= 3]
+    short_words = [word for word in words if len(word) < 3]
+    if not words:
+        return []
+
+    conditions = []
+    params = {'limit': limit, 'offset': offset}
+    if phrases:
+        conditions.append('blogs_fts MATCH :match')
+        params['match'] = ' '.join(phrases)
+    for i, word in enumerate(short_words):
+        conditions.append(f"(title LIKE :like{i} ESCAPE '\\' OR description LIKE :like{i} ESCAPE '\\' OR body LIKE :like{i} ESCAPE '\\')")
+        params[f'like{i}'] = '%' + word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+    if phrases:
+        # bm25 weights: title 10, description 5, body 1
+        columns = f"rowid, snippet(blogs_fts, -1, '{_MATCH_START}', '{_MATCH_END}', '…', 16)"
+        order = 'bm25(blogs_fts, 10.0, 5.0, 1.0)'
+    else:
+        # ranking functions are only available for MATCH queries, show the newest blogs first
+        columns = 'rowid, substr(description, 1, 100)'
+        order = 'rowid DESC'
+    rows = db.session.execute(
+        text(f"SELECT {columns} FROM blogs_fts WHERE {' AND '.join(conditions)} ORDER BY {order} LIMIT :limit OFFSET :offset"),
+        params,
+    ).all()
+    return [(id, html.escape(snippet or '').replace(_MATCH_START, '<mark>').replace(_MATCH_END, '</mark>')) for id, snippet in rows]
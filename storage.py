@@ -0,0 +1,230 @@
+import hashlib
+import hmac
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from flask import Request, current_app, url_for
+from werkzeug.security import safe_join
+
+# object storage of the uploaded images, selected with STORAGE_BACKEND:
+# 'cos' (Tencent Cloud COS, the production bucket) or 'local' (files under LOCAL_STORAGE_ROOT, for development and load tests)
+
+# keys named after the sha256 of the content (originals and variants) never change, they can be cached forever
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+_CONTENT_ADDRESSED_KEY = re.compile(r'(blog-images/[0-9a-f]{64}(\.[a-z0-9]+)?|image-variants/[0-9a-f]{64}/\d+\.\w+)')
+
+def is_immutable(key):
+    return _CONTENT_ADDRESSED_KEY.fullmatch(key) is not None
+
+# 正常情况日志级别使用 INFO，需要定位时可以修改为 DEBUG，此时 SDK 会打印和服务端的通信信息
+logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+class HashingSpooledFile(tempfile.SpooledTemporaryFile):
+    """
+    Spooled upload file that computes the sha256 of the content while the form parser writes it,
+    so the content hash of an upload is known without reading the file again.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return super().write(data)
+
+class HashingRequest(Request):
+    # the uploaded files of every request are HashingSpooledFile (same 500 KB in-memory limit as werkzeug's default)
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingSpooledFile(max_size=1024 * 500, mode='rb+')
+
+    # a resource can allow larger bodies than MAX_CONTENT_LENGTH with a max_content_length class attribute (e.g. batch uploads)
+    @property
+    def max_content_length(self):
+        view = current_app.view_functions.get(self.endpoint) if self.url_rule else None
+        limit = getattr(getattr(view, 'view_class', None), 'max_content_length', None)
+        return limit if limit is not None else super().max_content_length
+
+def content_hash(file):
+    """
+    The sha256 hex digest of an uploaded file.
+
+    :param file: The stream of a werkzeug FileStorage.
+    :return: The digest computed while the file was received, or by reading the file if it was not spooled by HashingRequest.
+    """
+    if isinstance(file, HashingSpooledFile):
+        return file.sha256.hexdigest()
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(1024 * 1024), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+class CosStorage:
+    """
+    Tencent Cloud COS bucket, the client is created on first use (in every gunicorn worker after the fork).
+    (files from STORAGE_MULTIPART_THRESHOLD bytes on are sent as a multipart upload with concurrent parts)
+    """
+
+    def __init__(self, app):
+        # 1. 设置用户属性, 包括 secret_id, secret_key, region等。Appid 已在 CosConfig 中移除，请在参数 Bucket 中带上 Appid。Bucket 由 BucketName-Appid 组成
+        self.secret_id = app.config['COS_SECRET_ID']      # 用户的 SecretId，建议使用子账号密钥，授权遵循最小权限指引，降低使用风险。子账号密钥获取可参见 https://cloud.tencent.com/document/product/598/37140
+        self.secret_key = app.config['COS_SECRET_KEY']    # 用户的 SecretKey，建议使用子账号密钥，授权遵循最小权限指引，降低使用风险。子账号密钥获取可参见 https://cloud.tencent.com/document/product/598/37140
+        self.region = app.config['COS_REGION']            # 已创建桶归属的 region 可以在控制台查看，https://console.cloud.tencent.com/cos5/bucket
+                                                          # COS 支持的所有 region 列表参见 https://cloud.tencent.com/document/product/436/6224
+        self.bucket = app.config['COS_BUCKET']
+        self.token = None                                 # 如果使用永久密钥不需要填入 token，如果使用临时密钥需要填入，临时密钥生成和使用指引参见 https://cloud.tencent.com/document/product/436/14048
+        self.scheme = 'https'                             # 指定使用 http/https 协议来访问 COS，默认为 https，可不填
+        self.multipart_threshold = app.config['STORAGE_MULTIPART_THRESHOLD']
+        self.part_size = app.config['STORAGE_PART_SIZE']
+        self.upload_threads = app.config['STORAGE_UPLOAD_THREADS']
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                # imported here, the local backend does not need the SDK
+                from qcloud_cos import CosConfig, CosS3Client
+                config = CosConfig(Region=self.region, SecretId=self.secret_id, SecretKey=self.secret_key, Token=self.token, Scheme=self.scheme)
+                self._client = CosS3Client(config)
+            return self._client
+
+    def put(self, key, stream, size, content_type=None):
+        """
+        Upload a file, read from the stream in chunks instead of being loaded into memory.
+
+        :param key: The object key (e.g. 'blog-images/<email>/<name>').
+        :param stream: A readable binary file object, positioned at the start.
+        :param size: The size of the file in bytes.
+        :param content_type: The Content-Type to store with the object.
+        """
+        headers = {'ContentType': content_type} if content_type else {}
+        if is_immutable(key):
+            # sent by COS (and its CDN) with every download of the object
+            headers['CacheControl'] = IMMUTABLE_CACHE_CONTROL
+        if size >= self.multipart_threshold:
+            # at most MaxBufferSize MB of parts are read ahead while MAXThread parts are uploaded
+            self.client.upload_file_from_buffer(
+                Bucket=self.bucket,
+                Key=key,
+                Body=stream,
+                PartSize=self.part_size,
+                MaxBufferSize=self.part_size * self.upload_threads * 2,
+                MAXThread=self.upload_threads,
+                **headers
+            )
+        else:
+            self.client.put_object(
+                Bucket=self.bucket,
+                Body=stream,
+                Key=key,
+                StorageClass='STANDARD',
+                EnableMD5=False,
+                **headers
+            )
+
+    def open(self, key):
+        # a readable stream of the object, read it in chunks and close it
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].get_raw_stream()
+
+    def url(self, key):
+        return f'https://{self.bucket}.cos.{self.region}.myqcloud.com/{key}'
+
+    def presign_put(self, key, expires):
+        # the client uploads the file to this url itself, the signature only allows a PUT of this key
+        return self.client.get_presigned_url(Bucket=self.bucket, Key=key, Method='PUT', Expired=expires)
+
+    def size(self, key):
+        # the size of a stored object in bytes, None if there is no such object
+        from qcloud_cos import CosServiceError
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except CosServiceError as e:
+            if e.get_status_code() == 404:
+                return None
+            raise
+        return int(response['Content-Length'])
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+class LocalStorage:
+    """
+    Files in a local directory, served by the '/storage/<key>' route of views.py (send_file, so gunicorn can use sendfile).
+    (presigned uploads are PUT to the same route, with an HMAC signature of the key and the expiry time)
+    """
+
+    def __init__(self, app):
+        self.root = app.config['LOCAL_STORAGE_ROOT']
+        self.secret = app.config['SECRET_KEY'].encode()
+
+    def path(self, key):
+        path = safe_join(self.root, key)
+        if path is None:
+            raise ValueError('Invalid storage key')
+        return path
+
+    def put(self, key, stream, size, content_type=None):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                shutil.copyfileobj(stream, file, 1024 * 1024)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def url(self, key):
+        return url_for('storage_file', key=key, _external=True)
+
+    def _signature(self, key, expires):
+        return hmac.new(self.secret, f'PUT\n{key}\n{expires}'.encode(), hashlib.sha256).hexdigest()
+
+    def presign_put(self, key, expires):
+        expires_at = int(time.time()) + expires
+        return url_for('storage_upload', key=key, expires=expires_at, signature=self._signature(key, expires_at), _external=True)
+
+    def verify_signature(self, key, expires, signature):
+        """
+        Check a presigned PUT url created by presign_put.
+
+        :param key: The key in the url.
+        :param expires: The expiry time (epoch seconds) in the url.
+        :param signature: The signature in the url.
+        :return: True if the signature matches and has not expired.
+        """
+        if not expires or not signature or not expires.isdigit() or int(expires) < time.time():
+            return False
+        return hmac.compare_digest(self._signature(key, int(expires)), signature)
+
+    def size(self, key):
+        path = self.path(key)
+        return os.path.getsize(path) if os.path.isfile(path) else None
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+def create_storage(app):
+    backend = app.config['STORAGE_BACKEND']
+    if backend == 'cos':
+        return CosStorage(app)
+    if backend == 'local':
+        return LocalStorage(app)
+    raise ValueError(f'Unknown STORAGE_BACKEND {backend!r}')
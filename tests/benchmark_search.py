@@ -0,0 +1,138 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# benchmark of the blog search (FTS5 index rebuild, save_to_db with indexing, /blogs/search latency) on a seeded database
+# run from the repository root: python tests/benchmark_search.py --blogs 100000
+# (uses a throwaway database in a temporary directory unless DATABASE_URL is set)
+
+_tmp_dir = tempfile.mkdtemp(prefix='bounden-benchmark-')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(_tmp_dir, 'users.db'))
+os.environ.setdefault('RATELIMIT_DATABASE_URL', 'sqlite:///' + os.path.join(_tmp_dir, 'ratelimit.db'))
+for name, value in (('SECRET_KEY', 'benchmark'), ('JWT_SECRET_KEY', 'benchmark'), ('MAIL_SERVER', 'localhost'),
+                    ('MAIL_PORT', '8025'), ('MAIL_USERNAME', 'bounden@localhost'), ('MAIL_USE_AUTH', 'false'),
+                    ('MAIL_OUTBOX_WORKER', 'false'), ('STORAGE_BACKEND', 'local')):
+    os.environ.setdefault(name, value)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db
+from models import Blog, User
+from sqlalchemy import insert
+import search
+
+# the vocabulary of the content: these words first, then generated ones, drawn with Zipf frequencies like real text
+WORDS = (
+    'travel mountain river coffee morning garden winter summer city train music piano guitar memory photo camera '
+    'friend family dinner recipe noodle dumpling festival lantern temple museum library novel poetry painting '
+    'ocean island sunset bicycle marathon hiking camping forest bamboo panda tea spring autumn harvest market '
+    '旅行 山川 咖啡 早晨 花园 冬天 夏天 城市 火车 音乐 钢琴 回忆 照片 朋友 家人 晚餐 饺子 灯笼 博物馆 图书馆 诗歌 大海 日落 森林 熊猫 春天 秋天'
+).split()
+
+VOCABULARY_SIZE = 20000
+
+def _vocabulary():
+    rng = random.Random(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    generated = {''.join(rng.choice(letters) for _ in range(rng.randint(4, 9))) for _ in range(VOCABULARY_SIZE)}
+    vocabulary = WORDS + sorted(generated - set(WORDS))[:VOCABULARY_SIZE - len(WORDS)]
+    cum_weights = []
+    total = 0
+    for rank in range(len(vocabulary)):
+        total += 1 / (rank + 1)
+        cum_weights.append(total)
+    return vocabulary, cum_weights
+
+VOCABULARY, CUM_WEIGHTS = _vocabulary()
+
+# the queries of the latency benchmark: the most frequent word, less frequent ones, two words, Chinese,
+# a rare generated word, a 3-letter word (a single trigram) and 2-letter words (LIKE fallback)
+QUERIES = ('travel', 'museum', 'mountain river', 'piano memory', '博物馆', VOCABULARY[5000], 'tea', '熊猫 春天')
+
+def _words(rng, count):
+    return ' '.join(rng.choices(VOCABULARY, cum_weights=CUM_WEIGHTS, k=count))
+
+def _paragraphs(rng, words):
+    return ''.join(f'<p>{_words(rng, 30)}</p>' for _ in range(words // 30))
+
+def seed_blogs(count, words=150, authors=100, seed=0):
+    """
+    Insert count blogs with random content (not indexed, see Blog.rebuild_search_index).
+
+    :param count: Number of blogs.
+    :param words: Number of words of the content of every blog.
+    :param authors: Number of users the blogs are spread over.
+    :param seed: Seed of the random content, the same seed gives the same database.
+    """
+    rng = random.Random(seed)
+    db.session.execute(insert(User), [
+        {'username': f'author{i}', 'email': f'author{i}@bounden.cn', 'password': 'not-a-hash', 'verified': True}
+        for i in range(authors)
+    ])
+    author_ids = [id for id, in db.session.query(User.id)]
+    now = int(time.time())
+    batch = []
+    for i in range(count):
+        batch.append({
+            'category': rng.choice(('life', 'travel', 'food', 'tech')),
+            'title': _words(rng, 4),
+            'description': _words(rng, 12),
+            'content': _paragraphs(rng, words),
+            'author_id': rng.choice(author_ids),
+            'created': now - count + i,
+            'updated': now - count + i,
+            'cover_image': '',
+        })
+        if len(batch) >= 1000:
+            db.session.execute(insert(Blog), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(Blog), batch)
+    db.session.commit()
+
+def _timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the blog search on a seeded database.')
+    parser.add_argument('--blogs', type=int, default=100000)
+    parser.add_argument('--words', type=int, default=150, help='words of content per blog')
+    parser.add_argument('--saves', type=int, default=100, help='blogs saved one by one with indexing')
+    parser.add_argument('--repeat', type=int, default=20, help='runs of every search query')
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        search.create_index()
+
+        _, elapsed = _timed(lambda: seed_blogs(args.blogs, words=args.words))
+        print(f'seed {args.blogs} blogs: {elapsed:.1f} s')
+        count, elapsed = _timed(Blog.rebuild_search_index)
+        print(f'rebuild index ({count} blogs): {elapsed:.1f} s')
+
+        author_id = db.session.query(User.id).first()[0]
+        rng = random.Random(1)
+        durations = []
+        for i in range(args.saves):
+            blog = Blog(category='life', title=f'benchmark {i}', description='', content=_paragraphs(rng, args.words),
+                        author_id=author_id, created=int(time.time()), updated=int(time.time()))
+            durations.append(_timed(blog.save_to_db)[1])
+        print(f'save_to_db with indexing: {statistics.median(durations) * 1000:.1f} ms median')
+
+    client = app.test_client()
+    for query in QUERIES:
+        durations = []
+        for _ in range(args.repeat):
+            response, elapsed = _timed(lambda: client.get('/blogs/search', query_string={'q': query, 'per_page': 10}))
+            assert response.status_code == 200, response.json
+            durations.append(elapsed)
+        print(f'/blogs/search?q={query}: {statistics.median(durations) * 1000:.1f} ms median, {len(response.json["blogs"])} result(s)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+
+# the app reads its settings from the environment when it is imported:
+# throwaway databases, local storage and no background threads or process pools
+_tmp_dir = tempfile.mkdtemp(prefix='bounden-tests-')
+os.environ.update({
+    'DATABASE_URL': 'sqlite:///' + os.path.join(_tmp_dir, 'users.db'),
+    'RATELIMIT_DATABASE_URL': 'sqlite:///' + os.path.join(_tmp_dir, 'ratelimit.db'),
+    'STORAGE_BACKEND': 'local',
+    'LOCAL_STORAGE_ROOT': os.path.join(_tmp_dir, 'storage'),
+    'MAIL_OUTBOX_WORKER': 'false',
+    'MAIL_USE_SSL': 'false',
+    'MAIL_USE_AUTH': 'false',
+    'RATELIMIT_ENABLED': 'false',
+    'TRUSTED_PROXIES': '1',
+    'PASSWORD_HASH_WORKERS': '0',
+    'THUMBNAIL_WORKERS': '0',
+})
+for name, value in (('SECRET_KEY', 'test'), ('JWT_SECRET_KEY', 'test'), ('MAIL_SERVER', 'localhost'),
+                    ('MAIL_PORT', '8025'), ('MAIL_USERNAME', 'bounden@localhost')):
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app as flask_app, db
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event, text
+import models
+import resources_blog
+import search
+
+@pytest.fixture
+def app():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.session.execute(text('DROP TABLE IF EXISTS blogs_fts'))
+        db.drop_all()
+        db.create_all()
+        search.create_index()
+        # the in-process caches are keyed by cache generations, which start over with the new database
+        models._identity_cache.clear()
+        models._blog_total_cache.clear()
+        resources_blog.feed_cache.clear()
+        yield flask_app
+        db.session.remove()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def seed_user(app):
+    def seed(email='user@bounden.cn', username='user'):
+        user = models.User(username=username, email=email, password='not-a-hash', verified=True)
+        user.save_to_db()
+        return user
+    return seed
+
+@pytest.fixture
+def auth(app):
+    def headers(email='user@bounden.cn'):
+        return {'Authorization': 'Bearer ' + create_access_token(identity=email)}
+    return headers
+
+@pytest.fixture
+def count_statements(app):
+    # with count_statements() as statements: ... -> the SQL statements sent to the database
+    @contextmanager
+    def counter():
+        statements = []
+        def listener(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+    return counter
@@ -0,0 +1,61 @@
+import hashlib
+import pytest
+from models import Blog, apply_text_patch
+
+# content patches use the offsets of the editor (JavaScript string indices, UTF-16 code units)
+
+def test_offsets_after_non_bmp_characters():
+    text = '<p>😀 hello</p>'
+    # in JavaScript '😀' has length 2, 'hello' starts at 6
+    assert apply_text_patch(text, [[6, 11, 'world']]) == '<p>😀 world</p>'
+    assert apply_text_patch(text, [[3, 5, '🎉🎉'], [6, 6, 'oh ']]) == '<p>🎉🎉 oh hello</p>'
+
+@pytest.mark.parametrize('patch', [
+    [[4, 4, 'x']],          # between the two halves of the emoji
+    [[0, 20, '']],          # past the end
+    [[5, 6, ''], [0, 1, '']],  # not sorted
+    [[0, 0, '\ud83d']],     # lone surrogate
+    [[0, 1]],
+    {'start': 0},
+])
+def test_invalid_patch(patch):
+    with pytest.raises(ValueError):
+        apply_text_patch('<p>😀 hello</p>', patch)
+
+@pytest.fixture
+def blog(seed_user):
+    user = seed_user()
+    blog = Blog(category='life', title='title', description='', content='<p>😀 hello</p>',
+                author_id=user.id, created=1700000000, updated=1700000000)
+    blog.save_to_db()
+    return blog.id
+
+def test_patch_content(client, auth, blog):
+    body = {'author_email': 'user@bounden.cn', 'version': 1, 'content_patch': [[6, 11, 'world']],
+            'content_sha256': hashlib.sha256('<p>😀 world</p>'.encode('utf-8')).hexdigest()}
+    response = client.patch(f'/blogs/edit/{blog}', json=body, headers=auth())
+    assert response.status_code == 200, response.json
+    assert response.json['version'] == 2
+    assert client.get(f'/blogs/{blog}/content').data.decode('utf-8') == '<p>😀 world</p>'
+
+def test_patch_hash_mismatch(client, auth, blog):
+    body = {'author_email': 'user@bounden.cn', 'version': 1, 'content_patch': [[6, 11, 'world']],
+            'content_sha256': hashlib.sha256(b'something else').hexdigest()}
+    response = client.patch(f'/blogs/edit/{blog}', json=body, headers=auth())
+    assert response.status_code == 400
+    assert client.get(f'/blogs/{blog}/content').data.decode('utf-8') == '<p>😀 hello</p>'
+
+@pytest.mark.parametrize('body', [[1], 'text', 3])
+def test_patch_body_not_an_object(client, auth, blog, body):
+    response = client.patch(f'/blogs/edit/{blog}', json=body, headers=auth())
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('changes', [{'title': None}, {'content': None, 'content_patch': [[0, 1, 'y']]}])
+def test_patch_null_field(client, auth, blog, changes):
+    body = {'author_email': 'user@bounden.cn', 'version': 1, **changes}
+    response = client.patch(f'/blogs/edit/{blog}', json=body, headers=auth())
+    assert response.status_code == 400
+    # nothing was saved and the session still works
+    assert client.get(f'/blogs/{blog}/content').data.decode('utf-8') == '<p>😀 hello</p>'
+    body = {'author_email': 'user@bounden.cn', 'version': 1, 'title': 'new title'}
+    assert client.patch(f'/blogs/edit/{blog}', json=body, headers=auth()).status_code == 200
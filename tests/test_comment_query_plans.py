@@ -0,0 +1,89 @@
+from contextlib import contextmanager
+import pytest
+from app import db
+from models import Blog, Comment
+from sqlalchemy import event
+
+# the comment queries are range scans of the (blog_id, depth, id) and (blog_id, path) indexes, never full scans
+
+@pytest.fixture
+def blog(seed_user):
+    user = seed_user()
+    blogs = []
+    for i in range(2):
+        blog = Blog(category='life', title=f'blog {i}', description='', content='<p>content</p>',
+                    author_id=user.id, created=1700000000, updated=1700000000)
+        blog.save_to_db()
+        blogs.append(blog.id)
+    reply = {'name': 'reply', 'email': 'reply@bounden.cn', 'content': 'reply'}
+    threads = [{'name': 'top', 'email': 'top@bounden.cn', 'content': 'top', 'replies': [dict(reply, replies=[reply, reply]), reply]}
+               for _ in range(20)]
+    for id in blogs:
+        Comment.bulk_insert(id, threads)
+    db.session.execute(db.text('ANALYZE'))
+    return blogs[0]
+
+@contextmanager
+def query_plans():
+    # the EXPLAIN QUERY PLAN details of the comment statements sent while the block runs: [(statement, [detail, ...])]
+    executed = []
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        if 'comments' in statement and not statement.startswith(('EXPLAIN', 'INSERT')):
+            executed.append((statement, parameters))
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    plans = []
+    try:
+        yield plans
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    connection = db.session.connection()
+    for statement, parameters in executed:
+        rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, tuple(parameters)).all()
+        plans.append((statement, [row[3] for row in rows]))
+
+def assert_uses_index(plans, index):
+    assert plans
+    for statement, details in plans:
+        if 'FROM comments' not in statement.replace('\n', ' '):
+            continue
+        assert not any(detail.startswith('SCAN') for detail in details), (statement, details)
+        assert any(f'USING INDEX {index}' in detail or f'USING COVERING INDEX {index}' in detail for detail in details), (statement, details)
+
+def top_level_path(blog):
+    return db.session.query(Comment.path).filter(Comment.blog_id == blog, Comment.depth == 1).order_by(Comment.id).first()[0]
+
+def test_top_level_comments(blog):
+    with query_plans() as plans:
+        assert len(Blog.get_comments(blog)['comments']) == 20
+    assert_uses_index(plans, 'ix_comments_blog_id_depth_id')
+
+def test_top_level_comments_page(blog):
+    with query_plans() as plans:
+        page = Blog.get_comments_page(blog, limit=5)
+        Blog.get_comments_page(blog, limit=5, cursor=page['next_cursor'])
+    assert_uses_index(plans, 'ix_comments_blog_id_depth_id')
+
+def test_replies(blog):
+    path = top_level_path(blog)
+    with query_plans() as plans:
+        assert len(Blog.get_comment_replies(blog, path)['replies']) == 4
+    assert_uses_index(plans, 'ix_comments_blog_id_path')
+
+def test_replies_page(blog):
+    path = top_level_path(blog)
+    with query_plans() as plans:
+        page = Blog.get_comment_replies_page(blog, path, limit=2, max_depth=1)
+        Blog.get_comment_replies_page(blog, path, limit=2, cursor=page['next_cursor'])
+    assert_uses_index(plans, 'ix_comments_blog_id_path')
+
+def test_comment_tree(blog):
+    with query_plans() as plans:
+        ''.join(Blog.iter_comment_tree(blog, max_depth=2))
+    assert_uses_index(plans, 'ix_comments_blog_id_path')
+
+def test_delete_by_path(blog):
+    path = top_level_path(blog)
+    with query_plans() as plans:
+        Comment.delete_by_path(path)
+    assert_uses_index([plan for plan in plans if plan[0].startswith('DELETE')], 'ix_comments_blog_id_path')
+    assert Blog.get_comment_replies(blog, path)['replies'] == []
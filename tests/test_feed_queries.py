@@ -0,0 +1,57 @@
+import pytest
+from models import Blog
+
+# a feed page costs a fixed number of statements whatever its size (no N+1 on the author), and never reads the content
+
+@pytest.fixture
+def blogs(seed_user):
+    authors = [seed_user(f'author{i}@bounden.cn', f'author{i}') for i in range(3)]
+    for i in range(30):
+        Blog(category='life', title=f'blog {i}', description='', content='<p>content</p>',
+             author_id=authors[i % 3].id, created=1700000000 + i, updated=1700000000 + i // 2).save_to_db()
+    return authors
+
+def reads_content(statements):
+    return any('blogs.content' in statement for statement in statements)
+
+@pytest.mark.parametrize('per_page', [2, 10, 25])
+def test_cursor_page_is_one_statement(blogs, count_statements, per_page):
+    with count_statements() as statements:
+        page = Blog.get_blogs_by_cursor(per_page=per_page, cursor='')
+    assert len(page['blogs']) == per_page
+    assert len(statements) == 1
+    assert not reads_content(statements)
+
+@pytest.mark.parametrize('per_page', [2, 10, 25])
+def test_paginated_page_is_page_and_count(blogs, count_statements, per_page):
+    with count_statements() as statements:
+        page = Blog.get_paginated_blogs(page=1, per_page=per_page, last_blog_id=0, last_blog_updated_time=None)
+    assert len(page['blogs']) == per_page
+    assert page['total'] == 30 and page['has_next'] == (per_page < 30)
+    # the page and the COUNT(*) of the total
+    assert len(statements) == 2
+    assert not reads_content(statements)
+
+def test_return_all_is_one_statement(blogs, count_statements):
+    with count_statements() as statements:
+        result = Blog.return_all()
+    assert len(result['blogs']) == 30
+    assert len(statements) == 1
+    assert not reads_content(statements)
+
+def test_user_blogs_page_is_one_statement(blogs, client, auth, count_statements):
+    headers = auth('author0@bounden.cn')
+    # the first request resolves the user, later requests hit the identity cache
+    assert client.post('/users/author0@bounden.cn/blogs', json={'cursor': ''}, headers=headers).status_code == 200
+    with count_statements() as statements:
+        response = client.post('/users/author0@bounden.cn/blogs', json={'cursor': '', 'per_page': 8}, headers=headers)
+    assert response.status_code == 200
+    assert len(response.json['blogs']) == 8
+    assert {blog['author']['email'] for blog in response.json['blogs']} == {'author0@bounden.cn'}
+    assert len(statements) == 1
+    assert not reads_content(statements)
+
+def test_delete_all_empties_the_cached_feed(blogs, client):
+    assert len(client.get('/blogs', query_string={'cursor': ''}).json['blogs']) > 0
+    Blog.delete_all()
+    assert client.get('/blogs', query_string={'cursor': ''}).json['blogs'] == []
@@ -0,0 +1,37 @@
+import io
+from PIL import Image as PILImage
+from app import storage
+from pool import ProcessPool
+from thumbnails import _render
+
+# variants are rendered from a file path, in the pool or on the calling thread
+
+def png(width, height):
+    output = io.BytesIO()
+    PILImage.new('RGB', (width, height), (200, 40, 40)).save(output, 'PNG')
+    output.seek(0)
+    return output
+
+def test_render_in_pool(tmp_path):
+    path = tmp_path / 'original.png'
+    path.write_bytes(png(1000, 500).getvalue())
+    variants = ProcessPool(1).run(_render, str(path), (320, 768, 1600), timeout=30)
+    # no upscaling past the original width
+    assert sorted({(width, name) for width, name, _ in variants}) == [(320, 'jpeg'), (320, 'webp'), (768, 'jpeg'), (768, 'webp')]
+    assert PILImage.open(io.BytesIO(variants[0][2])).size == (320, 160)
+
+def test_upload_stores_variants(client, auth, seed_user):
+    seed_user()
+    data = {'file': (png(800, 600), 'photo.png'), 'user_email': 'user@bounden.cn', 'name': 'photo.png'}
+    response = client.post('/images/upload', data=data, headers=auth(), content_type='multipart/form-data')
+    assert response.status_code == 200, response.json
+    assert sorted(response.json['variants']['webp']) == ['320', '768']
+    content_hash = response.json['url'].rsplit('/', 1)[1].split('.')[0]
+    assert storage.size(f'image-variants/{content_hash}/320.webp')
+
+def test_upload_of_a_non_image(client, auth, seed_user):
+    seed_user()
+    data = {'file': (io.BytesIO(b'not an image'), 'photo.png'), 'user_email': 'user@bounden.cn', 'name': 'photo.png'}
+    response = client.post('/images/upload', data=data, headers=auth(), content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert response.json['variants'] is None
@@ -0,0 +1,119 @@
+import socket
+import pytest
+from aiosmtpd.controller import Controller
+from app import app as flask_app, db
+from models import MailOutbox
+import models
+import outbox
+
+# the outbox sender against a local SMTP server (aiosmtpd)
+
+class RecordingHandler:
+    def __init__(self):
+        self.messages = []
+        self.sessions = set()
+        self.refused = set()
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.refused:
+            return '550 mailbox unavailable'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        # one session per SMTP connection
+        self.sessions.add(id(session))
+        self.messages.append((envelope.rcpt_tos[0], envelope.content.decode('utf-8', 'replace')))
+        return '250 Message accepted'
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture
+def smtp(app, monkeypatch):
+    handler = RecordingHandler()
+    controller = Controller(handler, hostname='127.0.0.1', port=free_port())
+    controller.start()
+    state = flask_app.extensions['mail']
+    monkeypatch.setattr(state, 'server', '127.0.0.1')
+    monkeypatch.setattr(state, 'port', controller.port)
+    yield handler
+    controller.stop()
+
+@pytest.fixture
+def clock(monkeypatch):
+    # the outbox reads the time through models.now_timestamp
+    now = [1700000000]
+    monkeypatch.setattr(models, 'now_timestamp', lambda: now[0])
+    return now
+
+def statuses():
+    return {row.recipient: (row.status, row.attempts) for row in MailOutbox.query.order_by(MailOutbox.id)}
+
+def test_batch_over_one_connection(smtp, clock, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'MAIL_OUTBOX_BATCH_SIZE', 5)
+    for i in range(12):
+        outbox.queue_mail(f'user{i}@bounden.cn', 'Hello', f'<p>message {i}</p>')
+    assert outbox.send_due() == 12
+    assert len(smtp.messages) == 12
+    # batches of 5, 5 and 2 messages
+    assert len(smtp.sessions) == 3
+    assert {status for status, _ in statuses().values()} == {'sent'}
+
+def test_dedup(smtp, clock):
+    assert outbox.queue_mail('user@bounden.cn', 'Verify', '<p>first</p>', dedup_key='verify:user@bounden.cn')
+    # a queued message gets the new content
+    assert outbox.queue_mail('user@bounden.cn', 'Verify', '<p>second</p>', dedup_key='verify:user@bounden.cn')
+    assert MailOutbox.query.count() == 1
+    outbox.send_due()
+    assert len(smtp.messages) == 1
+    assert 'second' in smtp.messages[0][1]
+
+    # sent within MAIL_DEDUP_WINDOW: dropped
+    clock[0] += flask_app.config['MAIL_DEDUP_WINDOW'] - 1
+    assert not outbox.queue_mail('user@bounden.cn', 'Verify', '<p>third</p>', dedup_key='verify:user@bounden.cn')
+    # after the window: sent again
+    clock[0] += 2
+    assert outbox.queue_mail('user@bounden.cn', 'Verify', '<p>fourth</p>', dedup_key='verify:user@bounden.cn')
+    outbox.send_due()
+    assert len(smtp.messages) == 2
+
+def test_refused_recipient_is_retried_with_backoff(smtp, clock):
+    delay = flask_app.config['MAIL_OUTBOX_RETRY_DELAY']
+    smtp.refused.add('refused@bounden.cn')
+    outbox.queue_mail('refused@bounden.cn', 'Hello', '<p>hello</p>')
+    outbox.queue_mail('user@bounden.cn', 'Hello', '<p>hello</p>')
+    outbox.send_due()
+    # only the refused message failed, the other one was sent over the same connection
+    assert statuses() == {'refused@bounden.cn': ('pending', 1), 'user@bounden.cn': ('sent', 0)}
+
+    # not due before the backoff, then due again with a doubled delay
+    clock[0] += delay - 1
+    assert outbox.send_due() == 0
+    clock[0] += 1
+    assert outbox.send_due() == 1
+    assert statuses()['refused@bounden.cn'] == ('pending', 2)
+    clock[0] += 2 * delay - 1
+    assert outbox.send_due() == 0
+
+    # delivered once the server accepts it
+    smtp.refused.clear()
+    clock[0] += 1
+    assert outbox.send_due() == 1
+    assert statuses()['refused@bounden.cn'] == ('sent', 2)
+
+def test_connection_failure(app, clock, monkeypatch):
+    # nothing listens on the port: every claimed message is retried, failed after the last attempt
+    monkeypatch.setattr(flask_app.extensions['mail'], 'port', free_port())
+    monkeypatch.setitem(flask_app.config, 'MAIL_OUTBOX_MAX_ATTEMPTS', 2)
+    outbox.queue_mail('user@bounden.cn', 'Hello', '<p>hello</p>')
+    outbox.send_due()
+    row = MailOutbox.query.one()
+    assert (row.status, row.attempts) == ('pending', 1)
+    assert row.last_error
+    clock[0] += flask_app.config['MAIL_OUTBOX_RETRY_DELAY']
+    outbox.send_due()
+    db.session.refresh(row)
+    assert (row.status, row.attempts) == ('failed', 2)
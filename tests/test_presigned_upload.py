@@ -0,0 +1,67 @@
+import re
+from urllib.parse import urlsplit
+import pytest
+from app import storage
+
+# presigned uploads against the local storage backend
+
+EMAIL = 'user@bounden.cn'
+
+@pytest.fixture
+def user(seed_user):
+    return seed_user(EMAIL)
+
+def presign(client, auth, name):
+    response = client.post('/images/presign', json={'user_email': EMAIL, 'name': name}, headers=auth(EMAIL))
+    assert response.status_code == 200, response.json
+    return response.json
+
+def upload(client, upload_url, data):
+    url = urlsplit(upload_url)
+    return client.put(url.path, query_string=url.query, data=data, content_type='image/png')
+
+def confirm(client, auth, key, name='photo.png'):
+    return client.post('/images/confirm', json={'user_email': EMAIL, 'name': name, 'key': key}, headers=auth(EMAIL))
+
+@pytest.mark.parametrize('name', ['photo.PNG', '../../other@bounden.cn/photo.png', 'a/b.png', 'no extension', 'x.png/..'])
+def test_key_ignores_the_client_name(client, auth, user, name):
+    key = presign(client, auth, name)['key']
+    assert re.fullmatch(r'blog-images/user@bounden\.cn/\d{8}_[0-9a-f]{32}(\.png)?', key), key
+
+def test_same_name_gets_distinct_keys(client, auth, user):
+    first = presign(client, auth, 'photo.png')
+    second = presign(client, auth, 'photo.png')
+    assert first['key'] != second['key']
+    assert upload(client, first['upload_url'], b'first').status_code == 200
+    assert upload(client, second['upload_url'], b'second').status_code == 200
+    with open(storage.path(first['key']), 'rb') as file:
+        assert file.read() == b'first'
+
+def test_confirm_once(client, auth, user):
+    presigned = presign(client, auth, 'photo.png')
+    assert confirm(client, auth, presigned['key']).status_code == 404
+    assert upload(client, presigned['upload_url'], b'image').status_code == 200
+    response = confirm(client, auth, presigned['key'])
+    assert response.status_code == 200, response.json
+    assert confirm(client, auth, presigned['key']).status_code == 409
+
+    images = client.get(f'/users/{EMAIL}/images', headers=auth(EMAIL)).json['images']
+    assert len(images) == 1
+    # deleting the image removes the uploaded object
+    assert client.delete(f'/images/{images[0]["id"]}', headers=auth(EMAIL)).status_code == 200
+    assert storage.size(presigned['key']) is None
+
+@pytest.mark.parametrize('key', ['blog-images/user@bounden.cn/../other.png', 'blog-images/other@bounden.cn/20240101_' + '0' * 32 + '.png',
+                                 'blog-images/user@bounden.cn/photo.png'])
+def test_confirm_rejects_other_keys(client, auth, user, key):
+    assert confirm(client, auth, key).status_code == 401
+
+def test_too_large_upload_is_rejected(client, auth, user, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'IMAGE_MAX_SIZE', 4)
+    presigned = presign(client, auth, 'photo.png')
+    assert upload(client, presigned['upload_url'], b'too large').status_code == 200
+
+    def failing_delete(key):
+        raise OSError('storage unavailable')
+    monkeypatch.setattr(storage, 'delete', failing_delete)
+    assert confirm(client, auth, presigned['key']).status_code == 413
@@ -0,0 +1,20 @@
+import pytest
+from app import app as flask_app
+
+# the ip buckets of the rate limits, behind one reverse proxy (TRUSTED_PROXIES=1)
+
+@pytest.fixture
+def limits(app, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'RATELIMIT_ENABLED', True)
+    monkeypatch.setitem(flask_app.config, 'RATELIMIT_IP_LIMIT', 2)
+
+def signin(client, ip, i):
+    # a new email every time, only the ip bucket fills up
+    return client.post('/signin', json={'email': f'user{i}@bounden.cn', 'password': 'password'},
+                       headers={'X-Forwarded-For': ip}, environ_base={'REMOTE_ADDR': '10.0.0.1'})
+
+def test_clients_behind_the_proxy_get_their_own_bucket(client, limits):
+    assert [signin(client, '203.0.113.1', i).status_code == 429 for i in range(3)] == [False, False, True]
+    # another client through the same proxy
+    assert signin(client, '203.0.113.2', 3).status_code != 429
+    assert signin(client, '203.0.113.1', 4).status_code == 429
@@ -0,0 +1,25 @@
+from benchmark_search import seed_blogs
+from models import Blog
+import search
+
+# the seeded database of the search benchmark, at a size the tests can afford
+
+def test_rebuild_and_search(app, client):
+    seed_blogs(300, words=60, authors=5)
+    assert Blog.rebuild_search_index() == 300
+
+    response = client.get('/blogs/search', query_string={'q': 'travel', 'per_page': 5})
+    assert response.status_code == 200
+    assert len(response.json['blogs']) == 5
+    assert response.json['has_next']
+    assert all('<mark>' in blog['snippet'] for blog in response.json['blogs'])
+
+def test_index_follows_writes(app, client, seed_user):
+    user = seed_user()
+    blog = Blog(category='life', title='Spring lanterns', description='', content='<p>a walk by the riverside</p>',
+                author_id=user.id, created=1700000000, updated=1700000000)
+    blog.save_to_db()
+    assert [id for id, _ in search.match('riverside', limit=10, offset=0)] == [blog.id]
+
+    Blog.delete_by_id(blog.id)
+    assert search.match('riverside', limit=10, offset=0) == []
@@ -0,0 +1,72 @@
+import io
+from pool import ProcessPool
+
+# resized variants of the uploaded images (for srcset), rendered in a process pool like the password hashes
+# every variant is stored as WebP and as JPEG (fallback for old browsers)
+
+FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+# runs in the worker processes, it has to be importable without the flask app
+def _render(path, widths):
+    """
+    Render the variants of an image.
+
+    :param path: The path of the original image file, opened by the pool process (the original is never copied between processes).
+    :param widths: The widths of the variants, wider than the original are skipped (no upscaling).
+    :return: A list of (width, format name, bytes) tuples.
+    """
+    from PIL import Image as PILImage, ImageOps
+    source = PILImage.open(path)
+    # JPEG can be decoded at a fraction of the size, enough for the widest variant
+    source.draft('RGB', (max(widths), max(widths)))
+    source = ImageOps.exif_transpose(source)
+    if source.mode not in ('RGB', 'RGBA'):
+        source = source.convert('RGBA' if 'transparency' in source.info or source.mode in ('LA', 'PA') else 'RGB')
+
+    variants = []
+    for width in sorted(widths):
+        if width >= source.width and variants:
+            break
+        width = min(width, source.width)
+        height = max(1, round(source.height * width / source.width))
+        resized = source.resize((width, height), PILImage.LANCZOS)
+        for name, (pil_format, _, options) in FORMATS.items():
+            image = resized
+            if pil_format == 'JPEG' and image.mode == 'RGBA':
+                # JPEG has no alpha channel, flatten onto white
+                image = PILImage.new('RGB', resized.size, (255, 255, 255))
+                image.paste(resized, mask=resized.getchannel('A'))
+            output = io.BytesIO()
+            image.save(output, pil_format, **options)
+            variants.append((width, name, output.getvalue()))
+    return variants
+
+class ThumbnailService:
+    """
+    Image variant rendering in a process pool (Pillow work is CPU-bound and holds the GIL).
+    """
+
+    def __init__(self, app=None):
+        self.widths = ()
+        self.timeout = None
+        self._pool = ProcessPool()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.widths = app.config['THUMBNAIL_WIDTHS']
+        self.timeout = app.config['THUMBNAIL_TIMEOUT']
+        self._pool = ProcessPool(app.config['THUMBNAIL_WORKERS'])
+
+    def render(self, path):
+        return self._pool.run(_render, path, self.widths, timeout=self.timeout)
+
+def srcset(variants):
+    # {'webp': {'320': url, ...}, 'jpeg': {...}} -> {'webp': 'url 320w, ...', 'jpeg': '...'}
+    return {
+        name: ', '.join(f'{url} {width}w' for width, url in sorted(urls.items(), key=lambda item: int(item[0])))
+        for name, urls in (variants or {}).items()
+    }
@@ -1,6 +1,34 @@
-from app import app
-from flask import jsonify
+from app import app, storage
+from flask import jsonify, request, send_from_directory
+from storage import IMMUTABLE_CACHE_CONTROL, LocalStorage, is_immutable
 
 @app.route('/')
 def index():
-    return jsonify({'message': 'Hello, World!'})
\ No newline at end of file
+    return jsonify({'message': 'Hello, World!'})
+
+# files of the local storage backend, with the cache headers a CDN / browser needs
+# (send_from_directory uses send_file: conditional requests, ranges and the server's sendfile through wsgi.file_wrapper)
+@app.route('/storage/<path:key>')
+def storage_file(key):
+    if not isinstance(storage, LocalStorage):
+        return jsonify({'message': 'Not found'}), 404
+    if is_immutable(key):
+        response = send_from_directory(storage.root, key, max_age=31536000)
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    else:
+        response = send_from_directory(storage.root, key, max_age=app.config['STORAGE_CACHE_MAX_AGE'])
+    return response
+
+# presigned uploads of the local storage backend (see LocalStorage.presign_put)
+@app.route('/storage/<path:key>', methods=['PUT'])
+def storage_upload(key):
+    if not isinstance(storage, LocalStorage):
+        return jsonify({'message': 'Not found'}), 404
+    if not storage.verify_signature(key, request.args.get('expires'), request.args.get('signature')):
+        return jsonify({'message': 'Invalid or expired signature'}), 403
+    try:
+        # the body is limited by MAX_CONTENT_LENGTH (413)
+        storage.put(key, request.stream, request.content_length, content_type=request.mimetype)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    return '', 200